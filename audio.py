@@ -0,0 +1,326 @@
+
+# audio.py - pre-encoded opus cache and playback sources
+
+import os, time, heapq, asyncio, logging, tempfile, itertools
+
+import discord
+from discord.oggparse import OggStream
+
+from constants import AUDIO_FILE_EXT, resolve_path
+from metrics import FFMPEG_SPAWNS
+
+
+# extension for cached, discord-ready opus files
+OPUS_FILE_EXT = 'opus'
+
+# worker pool priorities, lower runs first
+PRIORITY_OUTRO = 0
+PRIORITY_PLAY = 1
+PRIORITY_BACKGROUND = 2
+
+
+# Volume change (dB) bringing a track to target LUFS without pushing its peak past ceiling, None to leave as is
+def normalize_gain(meta, target, ceiling):
+    if target == 0 or meta is None or meta.get('loudness') is None:
+        return None
+
+    gain = target - meta['loudness']
+    if meta.get('peak') is not None:
+        gain = min(gain, ceiling - meta['peak'])
+    return round(gain, 2)
+
+
+class OpusCacheSource(discord.AudioSource):
+    '''Streams opus packets from a cached ogg file, no ffmpeg or encoder involved'''
+
+    def __init__(self, filename) -> None:
+        self._file = open(filename, 'rb')
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self) -> bytes:
+        for packet in self._packets:
+            # ogg opus header pages are not audio
+            if packet.startswith(b'OpusHead') or packet.startswith(b'OpusTags'):
+                continue
+            return packet
+        return b''
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FirstFrameSource(discord.AudioSource):
+    '''Passes another source through, calling on_first from the player thread once its first frame is read'''
+
+    def __init__(self, source: discord.AudioSource, on_first) -> None:
+        self.source = source
+        self._on_first = on_first
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if self._on_first is not None:
+            on_first, self._on_first = self._on_first, None
+            on_first()
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        self.source.cleanup()
+
+
+class AudioWorkerPool:
+    '''Process-wide cap on running ffmpeg work (live transcodes and cache encodes), granted by priority'''
+
+    def __init__(self, config, logger: logging.Logger) -> None:
+        self.logger = logger
+
+        self.limit = config.playback_workers
+        self.max_waiting = config.playback_max_waiting
+        self.max_wait = config.playback_max_wait
+
+        self._running = 0
+        self._waiting = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+
+        self._granted = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # Wait for a slot, lower priority tuples first; False when the pool is too busy to admit or the wait runs out
+    async def acquire(self, priority, admit=True):
+        if self._running < self.limit and len(self._waiting) == 0:
+            self._running += 1
+            self._record(0.0)
+            return True
+
+        if admit and self.depth() >= self.max_waiting:
+            self._rejected += 1
+            return False
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        start = time.monotonic()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait if admit else None)
+        except asyncio.TimeoutError:
+            # the slot may have been handed over as the wait ran out
+            if not future.done():
+                future.cancel()
+                self._rejected += 1
+                return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+        self._record(time.monotonic() - start)
+        return True
+
+    # A slot is free right now, nobody would be passed over
+    def available(self):
+        return self._running < self.limit and self.depth() == 0
+
+    # Hand the slot to the best waiter, or free it
+    def release(self):
+        while len(self._waiting) > 0:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running = max(0, self._running - 1)
+
+    def _record(self, waited):
+        self._granted += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+    # Waiters still in line, skipping ones that gave up
+    def depth(self):
+        return sum(1 for _, _, future in self._waiting if not future.done())
+
+    def stats(self):
+        return {
+            'running': self._running,
+            'limit': self.limit,
+            'waiting': self.depth(),
+            'granted': self._granted,
+            'rejected': self._rejected,
+            'wait_avg': self._wait_total / self._granted if self._granted > 0 else 0.0,
+            'wait_max': self._wait_max
+        }
+
+
+class OpusCache:
+    '''Sounds transcoded once to 48 kHz / 20 ms opus, keyed by blob hash or by global track'''
+
+    GLOBAL_KEY = 'global'
+
+    def __init__(self, config, logger: logging.Logger, pool: AudioWorkerPool = None) -> None:
+        self.config = config
+        self.logger = logger
+        self.pool = pool
+
+        self.enabled = config.opus_cache
+        self.cache_dir = resolve_path(config.audio_cache_dir, force_exists=False)
+        self.bitrate = config.opus_bitrate
+
+        # relative paths of every encoded file, so lookups never stat
+        self._entries = set()
+        self._encoding = {}  # key -> task encoding it, so concurrent requests share one ffmpeg
+
+        if self.enabled:
+            self._scan()
+
+    @property
+    def ffmpeg(self):
+        return self.config.ffmpeg_exe if os.path.isfile(self.config.ffmpeg_exe) else 'ffmpeg'
+
+    # Key for a sound stored by name, guild id None for global
+    @staticmethod
+    def track_key(guild_id, track_name):
+        return os.path.join(str(guild_id) if guild_id is not None else OpusCache.GLOBAL_KEY, f'{track_name}.{OPUS_FILE_EXT}')
+
+    # Key for a blob, shared by every guild that references it
+    @staticmethod
+    def blob_key(digest):
+        return os.path.join('blob', digest[:2], f'{digest}.{OPUS_FILE_EXT}')
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # Index what is already on disk
+    def _scan(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.' + OPUS_FILE_EXT):
+                    self._entries.add(os.path.relpath(os.path.join(dirpath, filename), self.cache_dir))
+
+        self.logger.debug(f'opus cache: {len(self._entries)} encoded sounds in {self.cache_dir}')
+
+    def has(self, key):
+        return self.enabled and key in self._entries
+
+    # Playback source for a cached sound, None on a miss
+    def source(self, key):
+        if not self.has(key):
+            return None
+
+        try:
+            return OpusCacheSource(self._path(key))
+        except OSError as e:
+            self.logger.warning(f'opus cache: dropping unreadable entry {key}: {str(e)}')
+            self._entries.discard(key)
+            return None
+
+    # Transcode one sound into the cache, applying gain (dB) so playback needs no volume filter;
+    # joins the encode already running for key, if any
+    async def encode(self, filename, key, gain=None):
+        if not self.enabled:
+            return False
+
+        task = self._encoding.get(key)
+        if task is None:
+            task = self._encoding[key] = asyncio.get_event_loop().create_task(self._encode(filename, key, gain))
+            task.add_done_callback(lambda _: self._encoding.pop(key, None))
+
+        # a caller giving up does not stop the encode others may be waiting on
+        return await asyncio.shield(task)
+
+    async def _encode(self, filename, key, gain):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        # a temp file of its own, so nothing else writing near target can clobber it
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.encode-', suffix='.tmp')
+        os.close(fd)
+
+        volume = ['-af', f'volume={gain}dB'] if gain else []
+
+        try:
+            # encodes are background work, they wait behind plays but are never turned away
+            if self.pool is not None:
+                await self.pool.acquire((PRIORITY_BACKGROUND, 0), admit=False)
+            try:
+                FFMPEG_SPAWNS.labels('encode').inc()
+                proc = await asyncio.create_subprocess_exec(
+                    self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+                    '-i', filename, '-vn', '-map_metadata', '-1', *volume,
+                    '-c:a', 'libopus', '-b:a', f'{self.bitrate}k', '-ar', '48000', '-ac', '2',
+                    '-frame_duration', '20', '-application', 'audio',
+                    '-f', 'ogg', temp,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                try:
+                    _, stderr = await proc.communicate()
+                except asyncio.CancelledError:
+                    proc.kill()
+                    await proc.wait()
+                    raise
+            except OSError as e:
+                self.logger.error(f'opus cache: could not run ffmpeg: {str(e)}')
+                return False
+            finally:
+                if self.pool is not None:
+                    self.pool.release()
+
+            if proc.returncode != 0:
+                self.logger.error(f'opus cache: encoding {filename} failed: {stderr.decode(errors="replace").strip()}')
+                return False
+
+            os.replace(temp, target)
+            self._entries.add(key)
+            self.logger.debug(f'opus cache: encoded {key}')
+            return True
+        finally:
+            if os.path.isfile(temp):
+                os.remove(temp)
+
+    # Cancel encodes still running, for shutdown
+    async def close(self):
+        tasks = list(self._encoding.values())
+        for task in tasks:
+            task.cancel()
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Drop a cached sound
+    def remove(self, key):
+        self._entries.discard(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    # Encode every sound in a directory that is not cached yet, one ffmpeg at a time
+    async def warm(self, audio_dir, guild_id=None, gain=None):
+        if not self.enabled or not os.path.isdir(audio_dir):
+            return
+
+        encoded = 0
+        for entry in os.scandir(audio_dir):
+            if not entry.is_file() or not entry.name.endswith('.' + AUDIO_FILE_EXT):
+                continue
+
+            track_name = entry.name[:-(len(AUDIO_FILE_EXT) + 1)]
+            key = OpusCache.track_key(guild_id, track_name)
+            if self.has(key):
+                continue
+
+            if await self.encode(entry.path, key, gain(track_name) if gain is not None else None):
+                encoded += 1
+
+        if encoded > 0:
+            self.logger.info(f'opus cache: encoded {encoded} sounds from {audio_dir}')
@@ -0,0 +1,148 @@
+
+# blobs.py - content-addressed sound files shared by every guild
+
+import os, shutil, hashlib, logging, tempfile
+
+from constants import AUDIO_FILE_EXT, COL_BLOBS, resolve_path
+
+
+# read size when hashing files
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+class BlobStore:
+    '''Sound files stored once by content hash, referenced by name from guild catalogs
+
+    Store collection (blob) layout:
+        blobs:   hash -> {refs, meta}, one per stored file
+        sources: hash of an upload as received -> hash of the blob it was transcoded to
+    '''
+
+    def __init__(self, config, store, logger: logging.Logger) -> None:
+        self.store = store
+        self.logger = logger
+
+        root = os.path.abspath(resolve_path(config.audio_root, force_exists=False))
+        self.blob_dir = os.path.join(root, config.audio_blob_storage)
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        if not self.store.has_collection(COL_BLOBS):
+            self.store.use_collection(COL_BLOBS)
+
+    @staticmethod
+    def hash_file(filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK_BYTES)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _section(self, key):
+        section = self.store.get_collection(COL_BLOBS).get(key)
+        return section if isinstance(section, dict) else {}
+
+    # Blobs are spread over subdirectories by hash prefix
+    def path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], f'{digest}.{AUDIO_FILE_EXT}')
+
+    def has(self, digest):
+        return digest in self._section('blobs') and os.path.isfile(self.path(digest))
+
+    def meta(self, digest):
+        entry = self._section('blobs').get(digest)
+        return entry.get('meta') if isinstance(entry, dict) else None
+
+    def refs(self, digest):
+        entry = self._section('blobs').get(digest)
+        return entry.get('refs', 0) if isinstance(entry, dict) else 0
+
+    # Empty temp file on the blob filesystem, so adding it is a rename
+    def temp(self):
+        fd, path = tempfile.mkstemp(dir=self.blob_dir, prefix='.blob-', suffix='.tmp')
+        os.close(fd)
+        return path
+
+    # Blob an upload was already transcoded to, or None
+    def find_source(self, source_digest):
+        digest = self._section('sources').get(source_digest)
+        return digest if digest is not None and self.has(digest) else None
+
+    def add_source(self, source_digest, digest):
+        self.store.set_collection_path(COL_BLOBS, ['sources', source_digest], digest)
+
+    # Move a file into the store by its hash, dropping it if the content is already there;
+    # copy leaves the original in place, for callers that delete it once the blob is recorded
+    def add(self, filename, digest=None, copy=False):
+        if digest is None:
+            digest = BlobStore.hash_file(filename)
+
+        target = self.path(digest)
+        if os.path.isfile(target):
+            if not copy:
+                os.remove(filename)
+            return digest
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if copy:
+            temp = self.temp()
+            try:
+                shutil.copyfile(filename, temp)
+                os.replace(temp, target)
+            except OSError:
+                if os.path.isfile(temp):
+                    os.remove(temp)
+                raise
+        else:
+            os.replace(filename, target)
+        return digest
+
+    # Delete a stored file nothing references
+    def discard(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _referenced(entry, meta):
+        entry = dict(entry) if isinstance(entry, dict) else {'refs': 0, 'meta': None}
+        entry['refs'] = entry.get('refs', 0) + 1
+        if meta is not None:
+            entry['meta'] = meta
+        return entry
+
+    # Take a reference for a new name, counted atomically when processes share the store
+    def ref(self, digest, meta=None):
+        self.store.update_collection_path(COL_BLOBS, ['blobs', digest], lambda entry: BlobStore._referenced(entry, meta))
+
+    # Take references for many names with a single collection write, refs is a list of (hash, meta)
+    def ref_many(self, refs):
+        blobs = dict(self._section('blobs'))
+        for digest, meta in refs:
+            blobs[digest] = BlobStore._referenced(blobs.get(digest), meta)
+
+        collection = dict(self.store.get_collection(COL_BLOBS))
+        collection['blobs'] = blobs
+        self.store.set_collection(COL_BLOBS, collection)
+        self.store.persist_collection(COL_BLOBS)
+
+    # Drop a reference, deleting the file with the last one; returns True if the blob is gone
+    def unref(self, digest):
+        def drop(entry):
+            if not isinstance(entry, dict) or entry.get('refs', 0) <= 1:
+                return None
+            return {**entry, 'refs': entry['refs'] - 1}
+
+        if self._section('blobs').get(digest) is None or self.store.update_collection_path(COL_BLOBS, ['blobs', digest], drop) is not None:
+            return False
+
+        # last reference gone
+        for source_digest in [s for s, d in self._section('sources').items() if d == digest]:
+            self.store.remove_collection_path(COL_BLOBS, ['sources', source_digest])
+
+        self.discard(digest)
+        self.logger.debug(f'blob store: dropped {digest}, no references left')
+        return True
@@ -1,7 +1,8 @@
 
 # bot.py - bot runner
 
-import os, logging, asyncio
+import os, time, signal, logging, asyncio, multiprocessing
+from multiprocessing.connection import wait
 
 from discord.ext import commands
 from dotenv import load_dotenv
@@ -13,59 +14,178 @@ from config import BotConfig
 from exceptions import BotLoadError, ConfigLoadError
 from soundbyte import Soundbyte
 from constants import resolve_path
-from constants import COL_GUILD, COL_SOUNDS, COL_GLOBAL, CONFIG_FILE
-from store import SimpleStorage, SimpleStorageException
+from constants import COL_GUILD, COL_SOUNDS, COL_GLOBAL, COL_BLOBS, CONFIG_FILE
+from store import SimpleStorageException, create_storage
+from metrics import MetricsServer, STORE_LOAD_SECONDS
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 
-try:
-    config = BotConfig(CONFIG_FILE)
-
-    intents = Intents.default()
-    intents.message_content = True
-
-    bot = commands.Bot(command_prefix=config.bot_prefix, help_command=None, intents=intents)
-    bot.remove_command('help')
-
-    logger = logging.getLogger(config.log_name)
-    logger.setLevel(config.log_level)
-    formatter = logging.Formatter('%(asctime)s - %(name)s [%(levelname)s] |   %(message)s')
-
-    file_handle = logging.FileHandler(resolve_path('out.log', force_exists=False), encoding='utf-8')
-    file_handle.setFormatter(formatter)
-    logger.addHandler(file_handle)
-
-    if config.log_stdout:
-        console_handle = logging.StreamHandler()
-        console_handle.setFormatter(formatter)
-        logger.addHandler(console_handle)
-
-    store = SimpleStorage(config.storage_dir)
-    store.load()
-    store.use_collection(COL_GUILD)
-    store.use_collection(f'{COL_SOUNDS}-{COL_GLOBAL}')
-
-    async def _startup():
-        await bot.add_cog(Soundbyte(bot, config=config, logger=logger, store=store))
-        logger.info('Soundbyte loaded')
-        await bot.start(TOKEN)
-
-    asyncio.get_event_loop().run_until_complete(_startup())
-
-except ConfigLoadError as e:
-    print(f'Error: {str(e)}')
-    exit(1)
-
-except (SimpleStorageException, BotLoadError) as e:
-    logger.error(str(e))
-    exit(1)
-
-except KeyboardInterrupt:
-    logger.info('Keyboard interrupt received, stopping bot')
-    exit(0)
-
-except Exception as e:
-    logger.error(f'[uncaught error] {str(e)}')
-    exit(1)
-    
\ No newline at end of file
+# Run the bot in this process, optionally for a subset of shards
+def run(shard_count=None, shard_ids=None, process_index=None):
+    store = None
+
+    try:
+        config = BotConfig(CONFIG_FILE)
+
+        intents = Intents.default()
+        intents.message_content = True
+
+        if shard_count is None:
+            bot = commands.Bot(command_prefix=config.bot_prefix, help_command=None, intents=intents)
+        else:
+            bot = commands.AutoShardedBot(command_prefix=config.bot_prefix, help_command=None, intents=intents, shard_count=shard_count, shard_ids=shard_ids)
+        bot.remove_command('help')
+
+        logger = logging.getLogger(config.log_name if process_index is None else f'{config.log_name}.{process_index}')
+        logger.setLevel(config.log_level)
+        formatter = logging.Formatter('%(asctime)s - %(name)s [%(levelname)s] |   %(message)s')
+
+        file_handle = logging.FileHandler(resolve_path('out.log', force_exists=False), encoding='utf-8')
+        file_handle.setFormatter(formatter)
+        logger.addHandler(file_handle)
+
+        if config.log_stdout:
+            console_handle = logging.StreamHandler()
+            console_handle.setFormatter(formatter)
+            logger.addHandler(console_handle)
+
+        # several processes share the store when shards are split between them
+        store = create_storage(config, logger=logger, shared=process_index is not None)
+        with STORE_LOAD_SECONDS.time():
+            store.load()
+        store.use_collection(COL_GUILD)
+        store.use_collection(f'{COL_SOUNDS}-{COL_GLOBAL}')
+        store.pin_collection(COL_GUILD)
+        store.pin_collection(f'{COL_SOUNDS}-{COL_GLOBAL}')
+        store.use_collection(COL_BLOBS)
+        store.pin_collection(COL_BLOBS)
+
+        async def _startup():
+            cog = Soundbyte(bot, config=config, logger=logger, store=store)
+            await bot.add_cog(cog)
+            logger.info('Soundbyte loaded')
+
+            # finish in-flight work, then close (unloading the cog) so the store is flushed below
+            async def _shutdown(name):
+                if cog.tasks.draining:
+                    return
+                logger.info(f'{name} received, stopping bot')
+                await cog.drain(config.shutdown_drain_seconds)
+                await bot.close()
+
+            loop = asyncio.get_event_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, lambda sig=sig: loop.create_task(_shutdown(sig.name)))
+                except NotImplementedError:
+                    # no loop signal handlers on windows, ctrl-c still stops the bot without draining
+                    pass
+
+            metrics = None
+            if config.metrics_enabled:
+                metrics = MetricsServer(config, logger, port=config.metrics_port + (process_index or 0))
+                try:
+                    await metrics.start()
+                except OSError as e:
+                    logger.error(f'could not serve metrics: {str(e)}')
+                    metrics = None
+
+            try:
+                await bot.start(TOKEN)
+            finally:
+                if metrics is not None:
+                    await metrics.close()
+
+        asyncio.get_event_loop().run_until_complete(_startup())
+
+    except ConfigLoadError as e:
+        print(f'Error: {str(e)}')
+        exit(1)
+
+    except (SimpleStorageException, BotLoadError) as e:
+        logger.error(str(e))
+        exit(1)
+
+    except KeyboardInterrupt:
+        logger.info('Keyboard interrupt received, stopping bot')
+        exit(0)
+
+    except Exception as e:
+        logger.error(f'[uncaught error] {str(e)}')
+        exit(1)
+
+    finally:
+        # write out anything still queued by write-behind
+        if store is not None:
+            try:
+                store.close()
+            except SimpleStorageException as e:
+                logger.error(f'error flushing storage on shutdown: {e.message}')
+
+
+# SIGTERM to the launcher stops it like ctrl-c
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+# Split shards between shard_processes processes, restarting any that die
+def launch(config):
+    count = max(config.shard_count, config.shard_processes)
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+
+    def start(index):
+        shard_ids = [shard for shard in range(count) if shard % config.shard_processes == index]
+        process = context.Process(target=run, name=f'soundbyte-{index}', kwargs={
+            'shard_count': count,
+            'shard_ids': shard_ids,
+            'process_index': index
+        })
+        process.start()
+        processes[index] = process
+        print(f'started process {index} (pid {process.pid}) for shards {shard_ids}')
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    for index in range(config.shard_processes):
+        start(index)
+
+    try:
+        while len(processes) > 0:
+            wait([process.sentinel for process in processes.values()])
+
+            for index, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+
+                del processes[index]
+                if process.exitcode != 0:
+                    print(f'process {index} exited with {process.exitcode}, restarting in {config.shard_restart_seconds}s')
+                    time.sleep(config.shard_restart_seconds)
+                    start(index)
+
+    except KeyboardInterrupt:
+        # each process drains and flushes on SIGTERM, past its deadline it is killed
+        for process in processes.values():
+            process.terminate()
+        deadline = time.monotonic() + config.shutdown_drain_seconds + 5
+        for process in processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f'process {process.name} did not stop in time, killing it')
+                process.kill()
+                process.join()
+
+
+# pool workers and shard processes started by spawn import this module, only the main process launches
+if __name__ == '__main__':
+    try:
+        config = BotConfig(CONFIG_FILE)
+    except ConfigLoadError as e:
+        print(f'Error: {str(e)}')
+        exit(1)
+
+    if config.shard_processes > 1:
+        launch(config)
+    else:
+        run(shard_count=config.shard_count if config.shard_count > 0 else None)
@@ -0,0 +1,229 @@
+
+# catalog.py - layered global/guild sound catalog
+
+import logging
+
+from constants import COL_SOUNDS, COL_GLOBAL
+from search import SoundSearch
+
+
+# layout version of guild overlay collections
+OVERLAY_VERSION = 2
+
+
+class SoundCatalog:
+    '''Read-only global sound layer plus a per-guild overlay
+
+    Guild collection (soundbit-<guild id>) layout:
+        bits:   track -> record, sounds added in this guild
+        hidden: track -> 1, global sounds removed in this guild
+        outro:  user id -> {track, display_name, id}
+    '''
+
+    def __init__(self, store, logger: logging.Logger) -> None:
+        self.store = store
+        self.logger = logger
+
+        # bumped on every change, so rendered views of a guild's catalog know when they are stale
+        self._global_version = 0
+        self._versions = {}
+
+        # name lookups, kept current by add and remove
+        self.search = SoundSearch(self)
+
+    # Changes whenever what a guild sees changes
+    def version(self, guild_id):
+        return (self._global_version, self._versions.get(guild_id, 0))
+
+    def _bump(self, guild_id):
+        self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+
+    # A guild's collection was changed from outside, e.g. by another process
+    def changed(self, guild_id):
+        self._bump(guild_id)
+        self.search.forget(guild_id)
+
+    # Call after editing the global layer
+    def global_changed(self):
+        self._global_version += 1
+        self.search.global_changed()
+
+    def _name(self, guild_id):
+        return f'{COL_SOUNDS}-{guild_id}'
+
+    # Track records of the global layer
+    def global_bits(self):
+        if not self.store.has_collection(f'{COL_SOUNDS}-{COL_GLOBAL}'):
+            return {}
+        bits = self.store.get_collection(f'{COL_SOUNDS}-{COL_GLOBAL}').get('bits')
+        return bits if isinstance(bits, dict) else {}
+
+    # Guild overlay, created on first use and migrated from the copied-catalog layout
+    def overlay(self, guild_id):
+        name = self._name(guild_id)
+        if not self.store.has_collection(name):
+            self.store.use_collection(name)
+            self.logger.info(f'first time guild [{guild_id}], creating collection')
+
+        overlay = self.store.get_collection(name)
+        if overlay.get('version') != OVERLAY_VERSION:
+            overlay = self._migrate(guild_id, overlay)
+        return overlay
+
+    # Older guild files hold a full copy of the global bits with outros nested in each track
+    def _migrate(self, guild_id, legacy):
+        global_bits = self.global_bits()
+
+        bits = legacy.get('bits', {})
+        if isinstance(bits, list):
+            bits = {track: {'name': track} for track in bits}
+        if not isinstance(bits, dict):
+            self.logger.error(f'error reading track store for guild [{guild_id}], starting empty')
+            bits = {}
+
+        overlay = {
+            'version': OVERLAY_VERSION,
+            'bits': {},
+            'hidden': {},
+            'outro': {}
+        }
+
+        for track_name, record in bits.items():
+            record = dict(record) if isinstance(record, dict) else {'name': track_name}
+
+            outro = record.pop('outro', None)
+            if isinstance(outro, dict):
+                for user_id, user in outro.items():
+                    overlay['outro'][str(user_id)] = {
+                        'track': track_name,
+                        'display_name': user.get('display_name', str(user_id)) if isinstance(user, dict) else str(user_id),
+                        'id': str(user_id)
+                    }
+
+            # global sounds are inherited, only keep what this guild added
+            if track_name not in global_bits:
+                overlay['bits'][track_name] = record
+
+        self.store.set_collection(self._name(guild_id), overlay)
+        self.store.persist_collection(self._name(guild_id))
+
+        if len(bits) > 0:
+            self.logger.info(f'migrated guild [{guild_id}] to overlay: {len(overlay["bits"])} own sounds, {len(overlay["outro"])} outros')
+        return overlay
+
+    # Track record through the layers, None if unknown or hidden
+    def get(self, guild_id, track_name):
+        overlay = self.overlay(guild_id)
+
+        record = overlay['bits'].get(track_name)
+        if record is not None:
+            return record
+        if track_name in overlay['hidden']:
+            return None
+        return self.global_bits().get(track_name)
+
+    def has(self, guild_id, track_name):
+        return self.get(guild_id, track_name) is not None
+
+    # Resolves to the global layer rather than the guild's own sounds
+    def is_global(self, guild_id, track_name):
+        overlay = self.overlay(guild_id)
+        return track_name not in overlay['bits'] and track_name not in overlay['hidden'] and track_name in self.global_bits()
+
+    # Every visible track name, global sounds first
+    def names(self, guild_id):
+        overlay = self.overlay(guild_id)
+        names = [track for track in self.global_bits() if track not in overlay['hidden'] and track not in overlay['bits']]
+        names.extend(overlay['bits'].keys())
+        return names
+
+    def add(self, guild_id, track_name, record):
+        overlay = self.overlay(guild_id)
+        if track_name in overlay['hidden']:
+            self.store.remove_collection_path(self._name(guild_id), ['hidden', track_name])
+        self.store.set_collection_path(self._name(guild_id), ['bits', track_name], record)
+        self.search.added(guild_id, track_name)
+        self._bump(guild_id)
+
+    # Add or replace many tracks in one layer (None = global) with a single collection write
+    def add_many(self, guild_id, records):
+        if guild_id is None:
+            name = f'{COL_SOUNDS}-{COL_GLOBAL}'
+            if not self.store.has_collection(name):
+                self.store.use_collection(name)
+            collection = dict(self.store.get_collection(name))
+            collection['bits'] = {**self.global_bits(), **records}
+        else:
+            name = self._name(guild_id)
+            collection = dict(self.overlay(guild_id))
+            collection['bits'] = {**collection['bits'], **records}
+            collection['hidden'] = {track: 1 for track in collection['hidden'] if track not in records}
+
+        self.store.set_collection(name, collection)
+        self.store.persist_collection(name)
+
+        if guild_id is None:
+            self.global_changed()
+        else:
+            for track_name in records:
+                self.search.added(guild_id, track_name)
+            self._bump(guild_id)
+
+    # Record as stored in one layer (None = global), without falling through
+    def own(self, guild_id, track_name):
+        if guild_id is None:
+            return self.global_bits().get(track_name)
+        if not self.store.has_collection(self._name(guild_id)):
+            return None
+        return self.overlay(guild_id)['bits'].get(track_name)
+
+    # Set one field of a track record in one layer (None = global), e.g. its metadata or blob;
+    # False if the track is no longer there, so late writes cannot bring a removed track back
+    def set_field(self, guild_id, track_name, field, value):
+        if not isinstance(self.own(guild_id, track_name), dict):
+            return False
+
+        if guild_id is None:
+            self.store.set_collection_path(f'{COL_SOUNDS}-{COL_GLOBAL}', ['bits', track_name, field], value)
+            self.global_changed()
+        else:
+            self.store.set_collection_path(self._name(guild_id), ['bits', track_name, field], value)
+            self._bump(guild_id)
+        return True
+
+    # Drop a guild sound, or hide a global one in this guild
+    def remove(self, guild_id, track_name):
+        overlay = self.overlay(guild_id)
+
+        if track_name in overlay['bits']:
+            self.store.remove_collection_path(self._name(guild_id), ['bits', track_name])
+            self.search.removed(guild_id, track_name)
+        elif track_name in self.global_bits():
+            self.store.set_collection_path(self._name(guild_id), ['hidden', track_name], 1)
+
+        for user_id in [user_id for user_id, user in overlay['outro'].items() if user['track'] == track_name]:
+            self.store.remove_collection_path(self._name(guild_id), ['outro', user_id])
+
+        self._bump(guild_id)
+
+    # User's outro track if it still resolves, else None
+    def outro(self, guild_id, user_id):
+        user = self.overlay(guild_id)['outro'].get(str(user_id))
+        if user is None or not self.has(guild_id, user['track']):
+            return None
+        return user['track']
+
+    def set_outro(self, guild_id, user_id, track_name, display_name):
+        self.store.set_collection_path(self._name(guild_id), ['outro', str(user_id)], {
+            'track': track_name,
+            'display_name': display_name,
+            'id': str(user_id)
+        })
+        self._bump(guild_id)
+
+    # Track -> display names of the users who have it as their outro
+    def outros_by_track(self, guild_id):
+        tracks = {}
+        for user in self.overlay(guild_id)['outro'].values():
+            tracks.setdefault(user['track'], []).append(user['display_name'])
+        return tracks
@@ -47,17 +47,58 @@ class BotConfig(metaclass=Singleton):
             # bot
             self.bot_prefix = config.get('bot', 'prefix', fallback='$')
             self.bot_title = config.get('bot', 'title', fallback='bot')
+            self.commands_reload_seconds = config.getint('bot', 'commands_reload_seconds', fallback=0)
+            self.list_page_size = config.getint('bot', 'list_page_size', fallback=25)
+            self.list_view_seconds = config.getfloat('bot', 'list_view_seconds', fallback=120)
+            self.list_cache_guilds = max(1, config.getint('bot', 'list_cache_guilds', fallback=64))
+            self.search_results = config.getint('bot', 'search_results', fallback=15)
+            self.search_suggestions = config.getint('bot', 'search_suggestions', fallback=3)
+            self.shutdown_drain_seconds = config.getfloat('bot', 'shutdown_drain_seconds', fallback=10)
+
+            # rate limits themselves are per command, in the commands file
+            self.ratelimit_enabled = config.getint('ratelimit', 'enabled', fallback=1)
+            self.ratelimit_notice_seconds = config.getfloat('ratelimit', 'notice_seconds', fallback=10)
 
             # audio
             self.audio_root = config.get('audio', 'storage_root')
             self.audio_server_storage = config.get('audio', 'server_storage')
             self.audio_common_storage = config.get('audio', 'common_storage')
+            self.audio_blob_storage = config.get('audio', 'blob_storage', fallback='blobs')
             self.ffmpeg_exe = config.get('audio', 'ffmpeg', fallback='thisisnotset')
             self.audio_timeout = config.getint('audio', 'timeout_seconds', fallback=8)
+            self.audio_timeout_slack = config.getfloat('audio', 'timeout_slack_seconds', fallback=2)
+            self.audio_rescan_seconds = config.getint('audio', 'rescan_seconds', fallback=0)
+            self.audio_normalize_lufs = config.getfloat('audio', 'normalize_lufs', fallback=0)
+            self.audio_peak_ceiling = config.getfloat('audio', 'peak_ceiling_db', fallback=-1)
+            self.audio_backfill_metadata = config.getint('audio', 'backfill_metadata', fallback=1)
+            self.opus_cache = config.getint('audio', 'opus_cache', fallback=1)
+            self.audio_cache_dir = config.get('audio', 'cache_dir', fallback='cache')
+            self.opus_bitrate = config.getint('audio', 'opus_bitrate_kbps', fallback=96)
+            self.ffprobe_exe = config.get('audio', 'ffprobe', fallback='thisisnotset')
+
+            self.ingest_max_bytes = config.getint('ingest', 'max_bytes', fallback=8388608)
+            self.ingest_max_seconds = config.getfloat('ingest', 'max_seconds', fallback=300)
+            self.ingest_concurrency = config.getint('ingest', 'concurrency', fallback=2)
+            self.ingest_workers = config.getint('ingest', 'workers', fallback=2)
+            self.ingest_bitrate = config.getint('ingest', 'bitrate_kbps', fallback=192)
+            self.ingest_timeout = config.getfloat('ingest', 'timeout_seconds', fallback=60)
             
-            self.outro_timeout = config.getint('outro', 'outro_timeout_seconds', fallback=8)
-            self.outro_user_dc_seconds = config.getint('outro', 'outro_user_dc_seconds', fallback=4)
-            self.outro_msg_seconds = config.getint('outro', 'outro_msg_seconds', fallback=2)
+            self.voice_connect_timeout = config.getfloat('voice', 'connect_timeout_seconds', fallback=10.0)
+            self.voice_idle_seconds = config.getfloat('voice', 'idle_seconds', fallback=120.0)
+            self.voice_reconnect_attempts = config.getint('voice', 'reconnect_attempts', fallback=3)
+            self.voice_reconnect_backoff = config.getfloat('voice', 'reconnect_backoff_seconds', fallback=1.0)
+
+            self.playback_queue_depth = config.getint('playback', 'queue_depth', fallback=10)
+            self.playback_overflow = config.get('playback', 'overflow', fallback='reject').lower()
+            self.playback_workers = max(1, config.getint('playback', 'workers', fallback=8))
+            self.playback_max_waiting = config.getint('playback', 'max_waiting', fallback=32)
+            self.playback_max_wait = config.getfloat('playback', 'max_wait_seconds', fallback=10)
+
+            self.outro_timeout = config.getfloat('outro', 'outro_timeout_seconds', fallback=8)
+            self.outro_user_dc_seconds = config.getfloat('outro', 'outro_user_dc_seconds', fallback=4)
+            self.outro_msg_seconds = config.getfloat('outro', 'outro_msg_seconds', fallback=2)
+            self.outro_user_dc_before_end = config.getfloat('outro', 'outro_user_dc_before_end_seconds', fallback=0.5)
+            self.outro_msg_before_end = config.getfloat('outro', 'outro_msg_before_end_seconds', fallback=2)
 
             # logging
             temp_level = config.get('logging', 'level', fallback='info').lower()
@@ -65,8 +106,26 @@ class BotConfig(metaclass=Singleton):
             self.log_name = config.get('logging', 'name', fallback=__name__)
             self.log_stdout = config.getint('logging', 'stdout', fallback=1)
 
+            # sharding
+            self.shard_count = config.getint('shard', 'count', fallback=0)
+            self.shard_processes = config.getint('shard', 'processes', fallback=1)
+            self.shard_restart_seconds = config.getfloat('shard', 'restart_seconds', fallback=5)
+            self.shard_sync_seconds = config.getfloat('shard', 'sync_seconds', fallback=1)
+
+            self.metrics_enabled = config.getint('metrics', 'enabled', fallback=0)
+            self.metrics_host = config.get('metrics', 'host', fallback='127.0.0.1')
+            self.metrics_port = config.getint('metrics', 'port', fallback=9108)
+            self.metrics_lag_interval = config.getfloat('metrics', 'lag_interval_seconds', fallback=1)
+
             # storage
             self.storage_dir = config.get('storage', 'dir')
+            self.storage_engine = config.get('storage', 'engine', fallback='simple').lower()
+            self.storage_journal_compact_bytes = config.getint('storage', 'journal_compact_bytes', fallback=1048576)
+            self.storage_sqlite_file = config.get('storage', 'sqlite_file', fallback='soundbyte.db')
+            self.storage_lazy = config.getint('storage', 'lazy', fallback=0)
+            self.storage_cache_collections = config.getint('storage', 'cache_collections', fallback=256)
+            self.storage_write_behind = config.getint('storage', 'write_behind', fallback=0)
+            self.storage_flush_interval = config.getfloat('storage', 'flush_interval_seconds', fallback=2.0)
 
 
             # checks ============================
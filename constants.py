@@ -15,12 +15,18 @@ COL_SOUNDS = 'soundbit'
 # global suffix
 COL_GLOBAL = 'global'
 
+# content-addressed sound files and their references
+COL_BLOBS = 'blob'
+
 # only consider these file types
 AUDIO_FILE_TYPES = ['mpeg']
 
 # save files to this extension
 AUDIO_FILE_EXT = 'mp3'
 
+# discord's limit on an embed description
+EMBED_DESC_MAX = 4096
+
 # admin
 GOD_IDS = [
     '239605736030601216', # nate
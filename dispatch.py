@@ -0,0 +1,128 @@
+
+# dispatch.py - precompiled command dispatch table
+
+import os, json, asyncio, logging
+
+from constants import resolve_path
+from exceptions import BotLoadError
+from ratelimit import parse_limits
+
+
+class CommandHandler:
+    '''Resolved command record, built once per commands file load'''
+
+    __slots__ = ('name', 'method', 'argmin', 'usage', 'permission', 'disabled', 'limits', 'concurrency')
+
+    def __init__(self, name, method, argmin=0, usage='', permission='any', disabled=False, limits=None, concurrency=0) -> None:
+        self.name = name
+        self.method = method
+        self.argmin = argmin
+        self.usage = usage
+        self.permission = permission
+        self.disabled = disabled
+        self.limits = limits if limits is not None else {}  # scope -> (count, seconds)
+        self.concurrency = concurrency  # running at once in this process, 0 = no cap
+
+
+class CommandDispatch:
+    '''Maps command names and aliases to resolved handlers for a cog'''
+
+    def __init__(self, cog, commands_file, logger: logging.Logger) -> None:
+        self.cog = cog
+        self.commands_file = resolve_path(commands_file)
+        self.logger = logger
+
+        self.commands = {}
+        self.table = {}
+        self._mtime = None
+
+    # Parse the commands file and build a new table, swapped in as a whole
+    def load(self):
+        try:
+            mtime = os.stat(self.commands_file).st_mtime
+            with open(self.commands_file, 'r') as file:
+                commands = json.loads(file.read())
+        except Exception as e:
+            raise BotLoadError(f'Commands file not parseable: {self.commands_file} [{str(e)}]')
+
+        table = {}
+        for cmd, data in commands.items():
+            handler = self._build_handler(cmd, data)
+            if handler is not None:
+                table[cmd] = handler
+
+        # aliases take priority over declared names
+        for cmd, data in commands.items():
+            if cmd in table and 'aliases' in data:
+                for alias in data['aliases']:
+                    table[alias] = table[cmd]
+
+        self.commands = commands
+        self.table = table
+        self._mtime = mtime
+
+        self.logger.debug(f'dispatch table built: {len(commands)} commands, {len(table)} entries')
+
+    # Resolve the coroutine and flags for a single command
+    def _build_handler(self, cmd, data):
+        disabled = 'disabled' in data and data['disabled'] == 1
+
+        permission = data.get('permission', 'any')
+        if permission is None or len(permission) == 0:
+            permission = 'any'
+
+        method = None
+        if not disabled:
+            method_name = data.get('function', cmd)
+            if not hasattr(self.cog, method_name):
+                self.logger.error(f'could not find function to call for command: {cmd}')
+                return None
+
+            method = getattr(self.cog, method_name)
+            if not asyncio.iscoroutinefunction(method):
+                self.logger.error(f'function not coroutine for command: {cmd}')
+                return None
+
+        return CommandHandler(
+            cmd,
+            method,
+            argmin=data.get('argmin', 0),
+            usage=data.get('usage', None),
+            permission=permission.lower(),
+            disabled=disabled,
+            limits=parse_limits(cmd, data.get('rate'), self.logger),
+            concurrency=data.get('concurrency', 0)
+        )
+
+    # Look up a command token (name or alias)
+    def get(self, command):
+        return self.table.get(command)
+
+    # Rebuild the table if the commands file changed on disk
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.commands_file).st_mtime
+        except OSError as e:
+            self.logger.error(f'could not stat commands file: {str(e)}')
+            return False
+
+        if mtime == self._mtime:
+            return False
+
+        try:
+            self.load()
+        except BotLoadError as e:
+            # keep serving the previous table
+            self._mtime = mtime
+            self.logger.error(f'commands reload failed: {e.message}')
+            return False
+
+        self.logger.info(f'reloaded commands file {self.commands_file}')
+        return True
+
+    # Poll the commands file for changes
+    async def watch(self, interval, on_reload=None):
+        while True:
+            await asyncio.sleep(interval)
+            if self.reload_if_changed() and on_reload is not None:
+                on_reload(self.commands)
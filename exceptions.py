@@ -25,3 +25,7 @@ class ConfigLoadError(FormattedException):
 class BotLoadError(FormattedException):
     """Raised if bot is not instantiated properly"""
     pass
+
+class IngestError(SoundbyteException):
+    """Raised if an uploaded sound is rejected, the message is shown to the user"""
+    pass
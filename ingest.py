@@ -0,0 +1,218 @@
+
+# ingest.py - streaming, validated, atomic intake of uploaded sounds
+
+import os, json, math, asyncio, hashlib, logging, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+from exceptions import IngestError
+from blobs import BlobStore
+
+
+# chunk size for streaming uploads to disk
+CHUNK_BYTES = 64 * 1024
+
+
+# Configured executable if it exists, else whatever is on PATH
+def find_tool(configured, name):
+    return configured if os.path.isfile(configured) else name
+
+
+# Runs in a pool worker: check the upload is audio we are willing to keep
+def probe(ffprobe, filename, max_seconds, timeout):
+    try:
+        result = subprocess.run([
+            ffprobe, '-v', 'error', '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name,sample_rate,channels:format=duration',
+            '-of', 'json', filename
+        ], capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise IngestError('Reading that file took too long')
+    except OSError as e:
+        raise IngestError(f'Could not run ffprobe: {str(e)}')
+
+    if result.returncode != 0:
+        raise IngestError('That file could not be read as audio')
+
+    try:
+        info = json.loads(result.stdout)
+    except ValueError:
+        raise IngestError('That file could not be read as audio')
+
+    streams = info.get('streams', [])
+    if len(streams) == 0:
+        raise IngestError('That file has no audio in it')
+
+    try:
+        duration = float(info.get('format', {}).get('duration', 0))
+    except (TypeError, ValueError):
+        duration = 0.0
+
+    if duration <= 0:
+        raise IngestError('That file has no audio in it')
+    if max_seconds > 0 and duration > max_seconds:
+        raise IngestError(f'Sounds can be at most {max_seconds:g} seconds long')
+
+    return {
+        'duration': duration,
+        'codec': streams[0].get('codec_name'),
+        'sample_rate': int(streams[0].get('sample_rate', 0) or 0),
+        'channels': int(streams[0].get('channels', 0) or 0)
+    }
+
+
+# Runs in a pool worker: integrated loudness (LUFS) and true peak (dBTP), None when silent
+def loudness(ffmpeg, filename, timeout):
+    try:
+        result = subprocess.run([
+            ffmpeg, '-hide_banner', '-nostats', '-i', filename, '-vn',
+            '-af', 'loudnorm=print_format=json', '-f', 'null', '-'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise IngestError('Measuring that file took too long')
+    except OSError as e:
+        raise IngestError(f'Could not run ffmpeg: {str(e)}')
+
+    # loudnorm prints its measurements as the last json object on stderr
+    text = result.stderr.decode(errors='replace')
+    start, end = text.rfind('{'), text.rfind('}')
+    if result.returncode != 0 or start < 0 or end < start:
+        raise IngestError('That file could not be measured')
+
+    try:
+        data = json.loads(text[start:end + 1])
+        integrated, peak = float(data['input_i']), float(data['input_tp'])
+    except (ValueError, KeyError):
+        raise IngestError('That file could not be measured')
+
+    return (integrated if math.isfinite(integrated) else None, peak if math.isfinite(peak) else None)
+
+
+# Runs in a pool worker: the metadata kept in a track record
+def analyze(ffprobe, ffmpeg, filename, timeout):
+    info = probe(ffprobe, filename, 0, timeout)
+    integrated, peak = loudness(ffmpeg, filename, timeout)
+    return {
+        'duration': round(info['duration'], 3),
+        'sample_rate': info['sample_rate'],
+        'channels': info['channels'],
+        'peak': peak,
+        'loudness': integrated
+    }
+
+
+# Runs in a pool worker: re-encode to the stored playback format
+def transcode(ffmpeg, source, target, bitrate, timeout):
+    try:
+        result = subprocess.run([
+            ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+            '-i', source, '-vn', '-map_metadata', '-1',
+            '-c:a', 'libmp3lame', '-b:a', f'{bitrate}k', '-ar', '48000', '-ac', '2',
+            '-f', 'mp3', target
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise IngestError('Converting that file took too long')
+    except OSError as e:
+        raise IngestError(f'Could not run ffmpeg: {str(e)}')
+
+    if result.returncode != 0:
+        raise IngestError(f'That file could not be converted: {result.stderr.decode(errors="replace").strip()[-200:]}')
+
+
+# Runs in a pool worker: validate, transcode and measure, so one upload costs one task
+def process(ffprobe, ffmpeg, source, target, max_seconds, bitrate, timeout):
+    probe(ffprobe, source, max_seconds, timeout)
+    transcode(ffmpeg, source, target, bitrate, timeout)
+    return analyze(ffprobe, ffmpeg, target, timeout)
+
+
+class SoundIngest:
+    '''Download, validate and transcode uploads off the event loop, with bounded concurrency'''
+
+    def __init__(self, config, logger: logging.Logger, blobs: BlobStore) -> None:
+        self.logger = logger
+        self.blobs = blobs
+
+        self.max_bytes = config.ingest_max_bytes
+        self.max_seconds = config.ingest_max_seconds
+        self.bitrate = config.ingest_bitrate
+        self.timeout = config.ingest_timeout
+        self.ffmpeg = find_tool(config.ffmpeg_exe, 'ffmpeg')
+        self.ffprobe = find_tool(config.ffprobe_exe, 'ffprobe')
+
+        # uploads past this many wait their turn instead of competing with playback for cpu
+        self._slots = asyncio.BoundedSemaphore(config.ingest_concurrency)
+        # spawned, not forked: this process already runs the storage flusher thread and the client loop
+        self._pool = ProcessPoolExecutor(max_workers=config.ingest_workers, mp_context=multiprocessing.get_context('spawn'))
+        self._session = None
+
+    # Stream, validate and transcode an attachment into the blob store; returns (blob hash, metadata)
+    async def ingest(self, attachment):
+        if attachment.size is not None and attachment.size > self.max_bytes:
+            raise IngestError(f'Sounds can be at most {self.max_bytes // 1024} KiB')
+
+        async with self._slots:
+            # temp files sit in the blob store so adding the result is a rename
+            download = self.blobs.temp()
+            converted = self.blobs.temp()
+            try:
+                source_digest = await self._download(attachment.url, download)
+
+                # the same upload was transcoded before, share its blob
+                digest = self.blobs.find_source(source_digest)
+                if digest is not None:
+                    self.logger.debug(f'ingest: upload matches blob {digest}, skipping transcode')
+                    return digest, self.blobs.meta(digest)
+
+                loop = asyncio.get_event_loop()
+                meta = await loop.run_in_executor(self._pool, process,
+                    self.ffprobe, self.ffmpeg, download, converted, self.max_seconds, self.bitrate, self.timeout)
+
+                digest = await loop.run_in_executor(None, BlobStore.hash_file, converted)
+                self.blobs.add(converted, digest)
+                self.blobs.add_source(source_digest, digest)
+                return digest, meta
+            finally:
+                for temp in (download, converted):
+                    try:
+                        os.remove(temp)
+                    except FileNotFoundError:
+                        pass
+
+    # Metadata for a file already in place, for backfilling older sounds
+    async def analyze(self, filename):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._pool, analyze, self.ffprobe, self.ffmpeg, filename, self.timeout)
+
+    # Stream a url to filename, returns the sha256 of what was received
+    async def _download(self, url, filename):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        received = 0
+        digest = hashlib.sha256()
+        try:
+            async with self._session.get(url) as resp:
+                if resp.status != 200:
+                    raise IngestError(f'Could not download that file (HTTP {resp.status})')
+
+                with open(filename, 'wb') as f:
+                    async for chunk in resp.content.iter_chunked(CHUNK_BYTES):
+                        # the declared size is not trusted, count what actually arrives
+                        received += len(chunk)
+                        if received > self.max_bytes:
+                            raise IngestError(f'Sounds can be at most {self.max_bytes // 1024} KiB')
+                        f.write(chunk)
+                        digest.update(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise IngestError(f'Could not download that file: {str(e) or type(e).__name__}')
+
+        self.logger.debug(f'ingest: downloaded {received} bytes to {filename}')
+        return digest.hexdigest()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._pool.shutdown(wait=False, cancel_futures=True)
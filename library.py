@@ -0,0 +1,107 @@
+
+# library.py - in-memory index of sound files on disk
+
+import os, asyncio, logging
+
+from constants import AUDIO_FILE_EXT, resolve_path
+
+
+class SoundIndex:
+    '''Maps (guild, track) to an absolute file path without touching the disk'''
+
+    def __init__(self, config, logger: logging.Logger) -> None:
+        self.logger = logger
+
+        root = os.path.abspath(resolve_path(config.audio_root, force_exists=False))
+        self.server_dir = os.path.join(root, config.audio_server_storage)
+        self.global_dir = os.path.join(root, config.audio_common_storage)
+        self.rescan_seconds = config.audio_rescan_seconds
+
+        self._global = {}  # track -> path
+        self._guilds = {}  # guild id (str) -> {track -> path}
+        self._mtimes = {}  # dir -> mtime at last scan
+
+    @staticmethod
+    def _scan_dir(path):
+        tracks = {}
+        suffix = '.' + AUDIO_FILE_EXT
+        for entry in os.scandir(path):
+            if entry.is_file() and entry.name.endswith(suffix):
+                tracks[entry.name[:-len(suffix)]] = entry.path
+        return tracks
+
+    # Full scan of audio_root, run once at startup
+    def scan(self):
+        self._global, self._guilds = self._scan_changed(full=True)
+        self.logger.info(f'sound index: {len(self._global)} global sounds, {sum(len(t) for t in self._guilds.values())} sounds in {len(self._guilds)} guilds')
+
+    # Rescan directories whose mtime moved, returns new (global, guilds) maps
+    def _scan_changed(self, full=False):
+        global_tracks = self._global
+        guilds = dict(self._guilds)
+        mtimes = {}
+
+        def changed(path):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return False
+            mtimes[path] = mtime
+            return full or self._mtimes.get(path) != mtime
+
+        if os.path.isdir(self.global_dir) and changed(self.global_dir):
+            global_tracks = SoundIndex._scan_dir(self.global_dir)
+
+        if os.path.isdir(self.server_dir):
+            seen = set()
+            for entry in os.scandir(self.server_dir):
+                if not entry.is_dir():
+                    continue
+                seen.add(entry.name)
+                if changed(entry.path):
+                    guilds[entry.name] = SoundIndex._scan_dir(entry.path)
+
+            for guild_id in list(guilds.keys()):
+                if guild_id not in seen:
+                    del guilds[guild_id]
+
+        self._mtimes = mtimes
+        return global_tracks, guilds
+
+    # Path and whether it is a global sound, or None when there is no file
+    def resolve(self, guild_id, track_name):
+        tracks = self._guilds.get(str(guild_id))
+        if tracks is not None and track_name in tracks:
+            return tracks[track_name], False
+
+        if track_name in self._global:
+            return self._global[track_name], True
+
+        return None
+
+    # (guild id or None for global, track, path) for every indexed file
+    def tracks(self):
+        for track_name, path in list(self._global.items()):
+            yield None, track_name, path
+
+        for guild_id, tracks in list(self._guilds.items()):
+            if not guild_id.isdigit():
+                continue
+            for track_name, path in list(tracks.items()):
+                yield int(guild_id), track_name, path
+
+    def remove(self, guild_id, track_name):
+        tracks = self._guilds.get(str(guild_id))
+        if tracks is not None:
+            tracks.pop(track_name, None)
+
+    # Pick up files dropped in by hand, scanning changed directories off the event loop
+    async def watch(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.rescan_seconds)
+            try:
+                self._global, self._guilds = await loop.run_in_executor(None, self._scan_changed)
+            except OSError as e:
+                self.logger.error(f'sound index: rescan failed: {str(e)}')
+
@@ -0,0 +1,268 @@
+
+# metrics.py - in-process counters, gauges and histograms, served in Prometheus text format
+
+import time, bisect, asyncio, logging, threading
+from contextlib import contextmanager
+
+
+# latency buckets in seconds, 1 ms to 10 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# longest request head the endpoint reads
+MAX_REQUEST_BYTES = 8192
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''One named metric, with a child per set of label values
+
+    Children are created on first use; updates take a lock so the storage flusher and player threads can record too.
+    '''
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()) -> None:
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._children = {}  # label values -> child
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', 'lock', 'fn')
+
+    def __init__(self, lock) -> None:
+        self.value = 0
+        self.lock = lock
+        self.fn = None
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    # Read the value from fn at scrape time instead
+    def set_function(self, fn):
+        self.fn = fn
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{self._label_text(values)} {_format(child.get())}']
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, fn):
+        self.labels().set_function(fn)
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds, lock) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # per bucket, the last one past every bound
+        self.sum = 0.0
+        self.lock = lock
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS) -> None:
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Buckets(self.buckets, self._lock)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _render_child(self, values, child):
+        with self._lock:
+            counts = list(child.counts)
+            total = child.sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{self._label_text(values, [("le", _format(bound))])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._label_text(values)} {_format(total)}')
+        lines.append(f'{self.name}_count{self._label_text(values)} {cumulative}')
+        return lines
+
+
+class Registry:
+    '''Every metric of the process, rendered together'''
+
+    def __init__(self) -> None:
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self._add(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+DISPATCH_SECONDS = REGISTRY.histogram('soundbyte_dispatch_seconds', 'on_message handling of prefixed messages, up to the command task starting')
+TASK_SECONDS = REGISTRY.histogram('soundbyte_task_seconds', 'Run time of supervised command and event tasks', ['task'])
+TASK_FAILURES = REGISTRY.counter('soundbyte_task_failures_total', 'Supervised tasks that raised', ['task'])
+STORE_LOAD_SECONDS = REGISTRY.histogram('soundbyte_store_load_seconds', 'Storage load at startup')
+STORE_WRITE_SECONDS = REGISTRY.histogram('soundbyte_store_write_seconds', 'Storage writes reaching disk: collection files, journal appends, database transactions')
+STORE_BYTES_WRITTEN = REGISTRY.counter('soundbyte_store_bytes_written_total', 'Serialized bytes handed to storage')
+STORE_CACHE_EVENTS = REGISTRY.counter('soundbyte_store_cache_total', 'Lazy storage collection lookups and evictions', ['event'])
+STORE_CACHE_RESIDENT = REGISTRY.gauge('soundbyte_store_cache_resident', 'Storage collections held in memory')
+VOICE_CONNECT_SECONDS = REGISTRY.histogram('soundbyte_voice_connect_seconds', 'Voice connects, retries included')
+FIRST_FRAME_SECONDS = REGISTRY.histogram('soundbyte_first_frame_seconds', 'From the command message to its first audio frame read by the player')
+FFMPEG_SPAWNS = REGISTRY.counter('soundbyte_ffmpeg_spawns_total', 'ffmpeg processes started on the event loop side', ['kind'])
+VOICE_CLIENTS = REGISTRY.gauge('soundbyte_voice_clients', 'Connected voice clients')
+VOICE_PLAYING = REGISTRY.gauge('soundbyte_voice_playing', 'Voice clients playing a sound')
+AUDIO_POOL_RUNNING = REGISTRY.gauge('soundbyte_audio_pool_running', 'Audio worker slots in use')
+AUDIO_POOL_WAITING = REGISTRY.gauge('soundbyte_audio_pool_waiting', 'Plays and encodes waiting for an audio worker slot')
+LOOP_LAG_SECONDS = REGISTRY.histogram('soundbyte_loop_lag_seconds', 'How late the event loop wakes a sleeping task')
+
+
+class MetricsServer:
+    '''Plain HTTP endpoint serving the registry on GET /metrics, plus an event loop lag probe'''
+
+    def __init__(self, config, logger: logging.Logger, registry: Registry = REGISTRY, port=None) -> None:
+        self.logger = logger
+        self.registry = registry
+
+        self.host = config.metrics_host
+        self.port = port if port is not None else config.metrics_port
+        self.lag_interval = config.metrics_lag_interval
+
+        self._server = None
+        self._lag_probe = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        if self.lag_interval > 0:
+            self._lag_probe = asyncio.get_event_loop().create_task(self._probe_lag())
+        self.logger.info(f'serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            request = head[:MAX_REQUEST_BYTES].split(b'\r\n', 1)[0].decode(errors='replace').split()
+
+            if len(request) >= 2 and request[0] == 'GET' and request[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # Sleep for interval and record how much longer it took
+    async def _probe_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - self.lag_interval))
+
+    async def close(self):
+        if self._lag_probe is not None:
+            self._lag_probe.cancel()
+            self._lag_probe = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
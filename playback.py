@@ -0,0 +1,139 @@
+
+# playback.py - per-guild playback queue and scheduler
+
+import asyncio, logging
+from collections import deque
+
+
+# what to do with a new request when a guild's queue is full
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_COALESCE = 'coalesce'
+
+OVERFLOW_POLICIES = [OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT, OVERFLOW_COALESCE]
+
+
+class PlayRequest:
+    '''One queued play'''
+
+    __slots__ = ('msg', 'track_name', 'timeout', 'events', 'cancelled')
+
+    def __init__(self, msg, track_name, timeout=None, events=None) -> None:
+        self.msg = msg
+        self.track_name = track_name
+        self.timeout = timeout
+        self.events = events
+        self.cancelled = False  # skipped before it started playing
+
+
+class PlaybackScheduler:
+    '''Bounded queue per guild, drained by a single consumer task'''
+
+    def __init__(self, play, stop, config, logger: logging.Logger) -> None:
+        # play(request) is awaited for each request, stop(guild_id) interrupts the current one
+        self._play = play
+        self._stop = stop
+        self.logger = logger
+
+        self.max_depth = config.playback_queue_depth
+        self.overflow = config.playback_overflow
+        if self.overflow not in OVERFLOW_POLICIES:
+            self.logger.warning(f'unknown playback overflow policy \'{self.overflow}\', using {OVERFLOW_REJECT}')
+            self.overflow = OVERFLOW_REJECT
+
+        self._queues = {}     # guild id -> deque of waiting requests
+        self._current = {}    # guild id -> request being played
+        self._consumers = {}  # guild id -> consumer task
+
+    # Queue a request, returns its position (0 = plays now) or None if rejected
+    def submit(self, guild_id, request: PlayRequest):
+        queue = self._queues.setdefault(guild_id, deque())
+        playing = 1 if guild_id in self._current else 0
+        # with nothing playing the head of the queue is about to start, it isn't waiting
+        starting = 1 - playing if len(queue) > 0 else 0
+
+        if self.overflow == OVERFLOW_COALESCE:
+            for idx, queued in enumerate(queue):
+                if queued.track_name == request.track_name and queued.events is None and request.events is None:
+                    return idx + playing
+
+        if len(queue) - starting >= self.max_depth:
+            if self.overflow == OVERFLOW_DROP_OLDEST and len(queue) > starting:
+                dropped = queue[starting]
+                del queue[starting]
+                self.logger.debug(f'playback queue full in guild {guild_id}, dropped \'{dropped.track_name}\'')
+            else:
+                return None
+
+        queue.append(request)
+        position = len(queue) - 1 + playing
+
+        if guild_id not in self._consumers:
+            self._consumers[guild_id] = asyncio.get_event_loop().create_task(self._consume(guild_id))
+
+        return position
+
+    async def _consume(self, guild_id):
+        queue = self._queues[guild_id]
+        try:
+            while len(queue) > 0:
+                request = queue.popleft()
+                self._current[guild_id] = request
+                try:
+                    await self._play(request)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.error(f'error playing \'{request.track_name}\' in guild {guild_id}: {str(e)}')
+                finally:
+                    self._current.pop(guild_id, None)
+        finally:
+            self._consumers.pop(guild_id, None)
+            if len(queue) == 0:
+                self._queues.pop(guild_id, None)
+
+    # Stop the current request, the next one starts right away; one still connecting or waiting for a slot never plays
+    def skip(self, guild_id):
+        request = self._current.get(guild_id)
+        if request is None:
+            return False
+        request.cancelled = True
+        self._stop(guild_id)
+        return True
+
+    # Drop every waiting request, returns how many
+    def clear(self, guild_id):
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            return 0
+        count = len(queue)
+        queue.clear()
+        return count
+
+    # Waiting requests for a guild
+    def depth(self, guild_id):
+        queue = self._queues.get(guild_id)
+        return len(queue) if queue is not None else 0
+
+    def current(self, guild_id):
+        return self._current.get(guild_id)
+
+    # Drop waiting requests and give the ones playing until timeout to finish, for shutdown
+    async def drain(self, timeout):
+        for queue in self._queues.values():
+            queue.clear()
+
+        consumers = list(self._consumers.values())
+        if len(consumers) > 0:
+            await asyncio.wait(consumers, timeout=timeout)
+
+    # Cancel every consumer, for shutdown
+    async def close(self):
+        for queue in self._queues.values():
+            queue.clear()
+
+        consumers = list(self._consumers.values())
+        for task in consumers:
+            task.cancel()
+        if len(consumers) > 0:
+            await asyncio.gather(*consumers, return_exceptions=True)
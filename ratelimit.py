@@ -0,0 +1,105 @@
+
+# ratelimit.py - token buckets for commands, per user, per guild and per command
+
+import time, logging
+
+
+# bucket scopes a command can limit on, keyed by the user, the guild, or nothing (the whole process)
+SCOPE_USER = 'user'
+SCOPE_GUILD = 'guild'
+SCOPE_COMMAND = 'command'
+
+SCOPES = [SCOPE_USER, SCOPE_GUILD, SCOPE_COMMAND]
+
+# seconds between sweeps of buckets that have refilled
+PRUNE_SECONDS = 60
+
+
+# Limits from a commands file entry, {scope: [count, seconds]} -> {scope: (count, seconds)}; bad entries are dropped
+def parse_limits(cmd, data, logger: logging.Logger):
+    limits = {}
+    if not isinstance(data, dict):
+        if data is not None:
+            logger.error(f'rate for command {cmd} is not an object, ignoring it')
+        return limits
+
+    for scope, limit in data.items():
+        try:
+            count, seconds = limit
+            count, seconds = int(count), float(seconds)
+        except (TypeError, ValueError):
+            logger.error(f'rate {scope} for command {cmd} is not [count, seconds], ignoring it')
+            continue
+
+        if scope not in SCOPES or count < 1 or seconds <= 0:
+            logger.error(f'rate {scope} for command {cmd} is not valid, ignoring it')
+            continue
+        limits[scope] = (count, seconds)
+
+    return limits
+
+
+class RateLimiter:
+    '''Token buckets holding up to count calls, refilled evenly over seconds
+
+    Buckets are created on first use and dropped once full again, so idle users cost nothing.
+    '''
+
+    def __init__(self, config, logger: logging.Logger) -> None:
+        self.logger = logger
+
+        self.enabled = config.ratelimit_enabled
+        self.notice_seconds = config.ratelimit_notice_seconds
+
+        self._buckets = {}  # (scope, command, user or guild id) -> [tokens, updated, time full again]
+        self._notices = {}  # (scope, user or guild id) -> time the last rejection was replied to
+        self._pruned = time.monotonic()
+
+    # Take a token from each of the command's buckets, all or none; returns None if allowed,
+    # else (scope, seconds until it would be)
+    def check(self, command, limits, user_id, guild_id):
+        if not self.enabled or len(limits) == 0:
+            return None
+
+        now = time.monotonic()
+        if now - self._pruned > PRUNE_SECONDS:
+            self._prune(now)
+
+        taken = []
+        rejected = None
+        for scope, (count, seconds) in limits.items():
+            key = (scope, command, user_id if scope == SCOPE_USER else guild_id if scope == SCOPE_GUILD else None)
+            rate = count / seconds
+
+            bucket = self._buckets.get(key)
+            tokens = count if bucket is None else min(count, bucket[0] + (now - bucket[1]) * rate)
+
+            if tokens < 1:
+                wait = (1 - tokens) / rate
+                if rejected is None or wait > rejected[1]:
+                    rejected = (scope, wait)
+            taken.append((key, tokens - 1, now + (count - tokens + 1) / rate))
+
+        if rejected is not None:
+            return rejected
+
+        for key, tokens, full in taken:
+            self._buckets[key] = [tokens, now, full]
+        return None
+
+    # Whether to reply to a rejection, once per user (or guild, for shared limits) every notice_seconds
+    def should_notify(self, scope, user_id, guild_id):
+        key = (SCOPE_USER, user_id) if scope == SCOPE_USER else (SCOPE_GUILD, guild_id)
+        now = time.monotonic()
+
+        last = self._notices.get(key)
+        if last is not None and now - last < self.notice_seconds:
+            return False
+        self._notices[key] = now
+        return True
+
+    # Buckets back at full hold nothing worth keeping
+    def _prune(self, now):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        self._notices = {key: last for key, last in self._notices.items() if now - last < self.notice_seconds}
+        self._pruned = now
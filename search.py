@@ -0,0 +1,171 @@
+
+# search.py - prefix and fuzzy lookups over sound names
+
+import heapq
+
+
+# least trigram similarity (0-1) for a fuzzy match
+SIMILARITY_CUTOFF = 0.3
+
+# trie node key holding the names that end at a node
+_END = ''
+
+
+def _trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    '''Trie and trigram postings over a set of names, matched case-insensitively'''
+
+    def __init__(self, names=()) -> None:
+        self._root = {}
+        self._grams = {}  # trigram -> names containing it
+        self._sizes = {}  # name -> number of distinct trigrams
+
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def add(self, name):
+        if name in self._sizes:
+            return
+
+        key = name.lower()
+        node = self._root
+        for ch in key:
+            node = node.setdefault(ch, {})
+        node.setdefault(_END, set()).add(name)
+
+        grams = _trigrams(key)
+        for gram in grams:
+            self._grams.setdefault(gram, set()).add(name)
+        self._sizes[name] = len(grams)
+
+    def remove(self, name):
+        if name not in self._sizes:
+            return
+
+        key = name.lower()
+        path = [self._root]
+        for ch in key:
+            path.append(path[-1][ch])
+
+        path[-1][_END].discard(name)
+        if len(path[-1][_END]) == 0:
+            del path[-1][_END]
+
+        # prune nodes left without names below them
+        for depth in range(len(key), 0, -1):
+            if len(path[depth]) > 0:
+                break
+            del path[depth - 1][key[depth - 1]]
+
+        for gram in _trigrams(key):
+            names = self._grams.get(gram)
+            if names is not None:
+                names.discard(name)
+                if len(names) == 0:
+                    del self._grams[gram]
+        del self._sizes[name]
+
+    # Names starting with text, alphabetically, generated lazily so callers stop when they have enough
+    def prefix(self, text):
+        node = self._root
+        for ch in text.lower():
+            node = node.get(ch)
+            if node is None:
+                return
+
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if _END in node:
+                yield from sorted(node[_END])
+            stack.extend(node[ch] for ch in sorted((ch for ch in node if ch != _END), reverse=True))
+
+    # name -> similarity (0-1) for names sharing trigrams with text
+    def similar(self, text):
+        grams = _trigrams(text.lower())
+        shared = {}
+        for gram in grams:
+            for name in self._grams.get(gram, ()):
+                shared[name] = shared.get(name, 0) + 1
+
+        return {name: 2 * count / (len(grams) + self._sizes[name]) for name, count in shared.items()}
+
+
+class SoundSearch:
+    '''Name lookups per guild: one index over the global sounds shared by all guilds, plus one per guild's own sounds
+
+    Indexes are built on first use and then kept current by the catalog as sounds are added and removed.
+    '''
+
+    def __init__(self, catalog) -> None:
+        self.catalog = catalog
+
+        self._global = None
+        self._guilds = {}  # guild id -> NameIndex of the guild's own sounds
+
+    def _global_index(self):
+        if self._global is None:
+            self._global = NameIndex(self.catalog.global_bits().keys())
+        return self._global
+
+    def _own_index(self, guild_id):
+        index = self._guilds.get(guild_id)
+        if index is None:
+            index = self._guilds[guild_id] = NameIndex(self.catalog.overlay(guild_id)['bits'].keys())
+        return index
+
+    # Catalog hooks
+    def added(self, guild_id, track_name):
+        if guild_id in self._guilds:
+            self._guilds[guild_id].add(track_name)
+
+    def removed(self, guild_id, track_name):
+        if guild_id in self._guilds:
+            self._guilds[guild_id].remove(track_name)
+
+    def global_changed(self):
+        self._global = None
+
+    def forget(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+    # Global names this guild can see that it does not also have as its own
+    def _inherited(self, guild_id, names):
+        overlay = self.catalog.overlay(guild_id)
+        return (name for name in names if name not in overlay['hidden'] and name not in overlay['bits'])
+
+    # Up to limit visible names starting with text, the guild's own sounds first
+    def prefix(self, guild_id, text, limit):
+        results = []
+        for names in (self._own_index(guild_id).prefix(text), self._inherited(guild_id, self._global_index().prefix(text))):
+            for name in names:
+                results.append(name)
+                if len(results) >= limit:
+                    return results
+        return results
+
+    # Up to limit visible names that look like text, best first
+    def similar(self, guild_id, text, limit, cutoff=SIMILARITY_CUTOFF):
+        scores = self._global_index().similar(text)
+        scores = {name: scores[name] for name in self._inherited(guild_id, scores)}
+        scores.update(self._own_index(guild_id).similar(text))
+
+        best = heapq.nlargest(limit, ((score, name) for name, score in scores.items() if score >= cutoff))
+        return [name for _, name in best]
+
+    # Prefix matches, then fuzzy ones, without repeats
+    def suggest(self, guild_id, text, limit):
+        results = self.prefix(guild_id, text, limit)
+        for name in self.similar(guild_id, text, limit):
+            if len(results) >= limit:
+                break
+            if name not in results:
+                results.append(name)
+        return results
@@ -1,17 +1,29 @@
 
 # soundbyte.py - The Soundbyte Cog
 
-import inspect
-import logging, os, json, asyncio
+import logging, os, asyncio
+from collections import OrderedDict
 
 import discord
 from discord.ext import commands
 
-from exceptions import BotLoadError
+from exceptions import BotLoadError, IngestError
 from config import BotConfig
 from constants import AUDIO_FILE_TYPES, resolve_path
-from constants import COL_GLOBAL, COL_GUILD, COL_SOUNDS, AUDIO_FILE_EXT, GOD_IDS
+from constants import COL_GLOBAL, COL_GUILD, COL_SOUNDS, GOD_IDS, EMBED_DESC_MAX
 from store import SimpleStorage, SimpleStorageException
+from dispatch import CommandDispatch
+from ratelimit import RateLimiter, SCOPE_USER, SCOPE_GUILD, SCOPE_COMMAND
+from supervisor import TaskSupervisor
+from metrics import DISPATCH_SECONDS, FIRST_FRAME_SECONDS, FFMPEG_SPAWNS
+from metrics import VOICE_CLIENTS, VOICE_PLAYING, AUDIO_POOL_RUNNING, AUDIO_POOL_WAITING, STORE_CACHE_EVENTS, STORE_CACHE_RESIDENT
+from audio import OpusCache, AudioWorkerPool, FirstFrameSource, PRIORITY_OUTRO, PRIORITY_PLAY, normalize_gain
+from blobs import BlobStore
+from voice import VoicePool, VoiceStateIndex
+from playback import PlaybackScheduler, PlayRequest
+from library import SoundIndex
+from catalog import SoundCatalog
+from ingest import SoundIngest
 
 class Soundbyte(commands.Cog):
     """Soundbyte discord Cog"""
@@ -31,30 +43,318 @@ class Soundbyte(commands.Cog):
             raise BotLoadError(f'Commands file not found: {commands_file}')
         self.commands_file = commands_file
 
-        try:
-            with open(commands_file, 'r') as file:
-                self.commands = json.loads(file.read())
-        except Exception as e:
-            raise BotLoadError(f'Commands file not parseable: {commands_file} [{str(e)}]')
-
-
         self.config: BotConfig = config
         self.logger: logging.Logger = logger
         self.store: SimpleStorage = store
+
+        # resolved command handlers by name and alias
+        self.dispatch = CommandDispatch(self, commands_file, self.logger)
+        self.dispatch.load()
+        self.commands = self.dispatch.commands
+
+        # buckets outlive commands file reloads, limits come from the handlers
+        self.limiter = RateLimiter(self.config, self.logger)
+
+        # command and event tasks, counted and capped, drained on shutdown
+        self.tasks = TaskSupervisor(self.logger)
+
         self.helper = SoundbyteHelp(self.config, self.commands)
+        # every ffmpeg this process runs, for plays and cache encodes, takes a slot here
+        self.audio_pool = AudioWorkerPool(self.config, self.logger)
+        self.opus_cache = OpusCache(self.config, self.logger, self.audio_pool)
+
+        # where every sound file lives, so plays never stat the disk
+        self.sounds = SoundIndex(self.config, self.logger)
+        self.sounds.scan()
+        self._sounds_watcher = None
+        self._preparer = None
+
+        # global sounds layered under each guild's own additions, removals and outros
+        self.catalog = SoundCatalog(self.store, self.logger)
+        self._list_cache = OrderedDict() # guild id -> (catalog version, rendered list pages), least recently listed first
+
+        # guild sounds are stored once per distinct file, names hold references
+        self.blobs = BlobStore(self.config, self.store, self.logger)
+
+        # uploads are downloaded and transcoded in worker processes, names being added are held here
+        self.ingest = SoundIngest(self.config, self.logger, self.blobs)
+        self._ingesting = set() # (guild id, track name)
+        self.voice_states = VoiceStateIndex(self.bot)
+        self.voice = VoicePool(self.bot, self.config, self.logger, self.voice_states)
+        self.playback = PlaybackScheduler(self._play_request, self._stop_playing, self.config, self.logger)
+        self._skipped = set() # guild ids whose current sound was stopped by a command
+
+        # guild id -> command prefix, the only thing on_message needs for non-commands
+        self.prefixes = self._load_prefixes()
 
         self.loop = asyncio.get_event_loop()
+        self._commands_watcher = None
+        self._store_watcher = None
+
+        # gauges read at scrape time, nothing to update as clients come and go
+        VOICE_CLIENTS.set_function(lambda: len(self.bot.voice_clients))
+        VOICE_PLAYING.set_function(lambda: sum(1 for vc in self.bot.voice_clients if vc.is_playing()))
+        AUDIO_POOL_RUNNING.set_function(lambda: self.audio_pool.stats()['running'])
+        AUDIO_POOL_WAITING.set_function(self.audio_pool.depth)
+        for event in ('hits', 'misses', 'evictions'):
+            STORE_CACHE_EVENTS.labels(event).set_function(lambda event=event: self.store.cache_stats()[event])
+        STORE_CACHE_RESIDENT.set_function(lambda: self.store.cache_stats()['resident'])
 
         self.logger.info('Instantiating bot...')
         
 
 
+    async def cog_load(self):
+        if self.config.audio_rescan_seconds > 0:
+            self._sounds_watcher = self.loop.create_task(self.sounds.watch())
+
+        # measure older sounds, then encode global sounds, in the background; plays fall back to ffmpeg until done
+        self._preparer = self.loop.create_task(self._prepare_sounds())
+
+        if self.config.commands_reload_seconds > 0:
+            self._commands_watcher = self.loop.create_task(
+                self.dispatch.watch(self.config.commands_reload_seconds, on_reload=self._on_commands_reload))
+
+        # other shard processes write to the same store
+        if self.store.shared:
+            self._store_watcher = self.loop.create_task(self._watch_store())
+
+
+    # Stop taking commands, then give running commands and the sounds already playing until timeout to finish
+    async def drain(self, timeout):
+        deadline = self.loop.time() + timeout
+        await self._stop_preparing()
+        await self.tasks.drain(timeout)
+        await self.playback.drain(max(0, deadline - self.loop.time()))
+
+
+    async def cog_unload(self):
+        if self._commands_watcher is not None:
+            self._commands_watcher.cancel()
+            self._commands_watcher = None
+
+        if self._sounds_watcher is not None:
+            self._sounds_watcher.cancel()
+            self._sounds_watcher = None
+
+        if self._store_watcher is not None:
+            self._store_watcher.cancel()
+            self._store_watcher = None
+
+        await self._stop_preparing()
+        await self.playback.close()
+        await self.voice.close()
+        await self.ingest.close()
+
+
+    # Background preparation resumes on the next start, stop it and any encode it left running
+    async def _stop_preparing(self):
+        if self._preparer is not None:
+            self._preparer.cancel()
+            await asyncio.gather(self._preparer, return_exceptions=True)
+            self._preparer = None
+        await self.opus_cache.close()
+
+
+    async def _prepare_sounds(self):
+        await self._migrate_blobs()
+        if self.config.audio_backfill_metadata:
+            await self._backfill_meta()
+        if self._owns(None):
+            await self.opus_cache.warm(self.sounds.global_dir, gain=lambda track_name: self._gain(None, track_name))
+
+
+    # Whether this process prepares a guild's sounds (None = global sounds), so sharded processes split the work
+    def _owns(self, guild_id):
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if shard_ids is None or not self.bot.shard_count:
+            return True
+        shard = 0 if guild_id is None else (guild_id >> 22) % self.bot.shard_count
+        return shard in shard_ids
+
+
+    # Move guild sound files from before the blob store into it, sharing identical files
+    async def _migrate_blobs(self):
+        migrated = [] # (guild id, track name, original file) of every sound now in the blob store
+        for guild_id, track_name, filename in list(self.sounds.tracks()):
+            if guild_id is None or not self._owns(guild_id):
+                continue
+
+            record = self.catalog.own(guild_id, track_name)
+            if not isinstance(record, dict):
+                continue
+
+            # stopped after the record was saved but before the original was removed
+            if 'blob' in record:
+                if self.blobs.has(record['blob']):
+                    migrated.append((guild_id, track_name, filename))
+                continue
+
+            # copied, the original goes only once the record pointing at the blob is on disk
+            try:
+                digest = await self.loop.run_in_executor(None, BlobStore.hash_file, filename)
+                await self.loop.run_in_executor(None, lambda: self.blobs.add(filename, digest, copy=True))
+            except OSError as e:
+                self.logger.error(f'could not move \'{track_name}\' ({filename}) to the blob store: {str(e)}')
+                continue
+
+            meta = record.get('meta') or self.blobs.meta(digest)
+            if meta is None:
+                try:
+                    meta = await self.ingest.analyze(self.blobs.path(digest))
+                except IngestError as e:
+                    self.logger.warning(f'could not measure \'{track_name}\': {e.message}')
+
+            # removed while it was being hashed or measured, nothing to point at the blob
+            if not isinstance(self.catalog.own(guild_id, track_name), dict):
+                if self.blobs.refs(digest) == 0:
+                    self.blobs.discard(digest)
+                continue
+
+            self.blobs.ref(digest, meta)
+            self.catalog.set_field(guild_id, track_name, 'blob', digest)
+            if meta is not None:
+                self.catalog.set_field(guild_id, track_name, 'meta', meta)
+            migrated.append((guild_id, track_name, filename))
+
+            # the cache moves from per-guild entries to one per blob
+            self.opus_cache.remove(OpusCache.track_key(guild_id, track_name))
+            key = OpusCache.blob_key(digest)
+            if not self.opus_cache.has(key):
+                await self.opus_cache.encode(self.blobs.path(digest), key, normalize_gain(meta, self.config.audio_normalize_lufs, self.config.audio_peak_ceiling))
+
+        if len(migrated) == 0:
+            return
+
+        # write-behind may still hold the new records, get them on disk before dropping the originals
+        try:
+            await self.loop.run_in_executor(None, self.store.flush)
+        except SimpleStorageException as e:
+            self.logger.error(f'could not save blob store migration, keeping the original files: {e.message}')
+            return
+
+        for guild_id, track_name, filename in migrated:
+            self.sounds.remove(guild_id, track_name)
+            try:
+                os.remove(filename)
+            except OSError as e:
+                self.logger.warning(f'could not remove migrated sound file {filename}: {str(e)}')
+
+        self.logger.info(f'moved {len(migrated)} guild sound files to the blob store')
+
+
+    # Measure every stored sound without metadata, one at a time so uploads keep their workers
+    async def _backfill_meta(self):
+        measured = 0
+        for guild_id, track_name, filename in list(self.sounds.tracks()):
+            if not self._owns(guild_id):
+                continue
+
+            record = self.catalog.own(guild_id, track_name)
+            if not isinstance(record, dict) or 'meta' in record:
+                continue
+
+            try:
+                meta = await self.ingest.analyze(filename)
+            except IngestError as e:
+                self.logger.warning(f'could not measure \'{track_name}\' ({filename}): {e.message}')
+                continue
+
+            # removed while it was being measured
+            if not self.catalog.set_field(guild_id, track_name, 'meta', meta):
+                continue
+            measured += 1
+
+            # anything already encoded predates normalization, encode it again
+            key = OpusCache.track_key(guild_id, track_name)
+            if self.opus_cache.has(key):
+                await self.opus_cache.encode(filename, key, normalize_gain(meta, self.config.audio_normalize_lufs, self.config.audio_peak_ceiling))
+
+        if measured > 0:
+            self.logger.info(f'measured {measured} sounds without metadata')
+
+
+    # Stored record for the track a guild resolves to (None = global), or None
+    def _record(self, guild_id, track_name):
+        record = self.catalog.get(guild_id, track_name) if guild_id is not None else self.catalog.global_bits().get(track_name)
+        return record if isinstance(record, dict) else None
+
+
+    def _meta(self, guild_id, track_name):
+        record = self._record(guild_id, track_name)
+        return record.get('meta') if record is not None else None
+
+
+    def _gain(self, guild_id, track_name):
+        return normalize_gain(self._meta(guild_id, track_name), self.config.audio_normalize_lufs, self.config.audio_peak_ceiling)
+
+
+    # Pick up storage changes made by other processes and drop what was cached from the old data
+    async def _watch_store(self):
+        while True:
+            await asyncio.sleep(self.config.shard_sync_seconds)
+            try:
+                changed = self.store.poll_changes()
+            except SimpleStorageException as e:
+                self.logger.error(f'could not read storage changes: {e.message}')
+                continue
+
+            for name, keys in changed.items():
+                if name == COL_GUILD:
+                    if None in keys:
+                        self.prefixes = self._load_prefixes()
+                    else:
+                        # guild registrations elsewhere touch one entry each, not the whole table
+                        for guild in keys:
+                            self._reload_prefix(guild)
+                elif name == f'{COL_SOUNDS}-{COL_GLOBAL}':
+                    self.catalog.global_changed()
+                elif name.startswith(f'{COL_SOUNDS}-') and name[len(COL_SOUNDS) + 1:].isdigit():
+                    self.catalog.changed(int(name[len(COL_SOUNDS) + 1:]))
+
+
+    # Commands file changed on disk
+    def _on_commands_reload(self, commands):
+        self.commands = commands
+        self.helper.set_commands(commands)
+
+
     @commands.Cog.listener()
     async def on_ready(self):
         await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=f'{self.config.bot_prefix}help'))
+
+        for guild in self.bot.guilds:
+            self.voice_states.rebuild(guild)
+
         self.logger.info('Bot is ready')
 
 
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        self.voice_states.rebuild(guild)
+
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.voice_states.rebuild(guild)
+
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.voice_states.forget(guild)
+        self._list_cache.pop(guild.id, None)
+        self.catalog.search.forget(guild.id)
+
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        self.voice_states.update(member, before, after)
+
+        # our own client dropped out of voice
+        if member.id == self.bot.user.id and before.channel is not None and after.channel is None:
+            self.voice.handle_disconnect(member.guild)
+
+
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
         if not isinstance(error, commands.errors.CommandNotFound):
@@ -63,131 +363,164 @@ class Soundbyte(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, msg: discord.Message):
-        guild = str(msg.guild.id)
-        guilds = self.store.get_collection(COL_GUILD)
+        if msg.guild is None:
+            return
 
-        guild_setup = False
+        # most messages are not commands, get them out before touching anything else
+        prefix = self.prefixes.get(msg.guild.id)
+        if prefix is None:
+            prefix = self._register_guild(msg.guild.id)
 
-        # make sure to load guild data
-        if guild not in guilds:
-            guilds[guild] = {}
-            guild_setup = True
-        
-        # set up guild specific data
-        if 'prefix' not in guilds[guild]:
-            guilds[guild]['prefix'] = self.config.bot_prefix
-            guild_setup = True
+        # leading whitespace was always allowed before the prefix
+        if msg.content.lstrip()[:1] != prefix:
+            return
+
+        # only resolving the command is timed, replies wait on discord
+        with DISPATCH_SECONDS.time():
+            reply = self._dispatch(msg, prefix)
 
-        # first time write
-        if guild_setup:
-            self.store.set_collection(COL_GUILD, guilds)
-            self.store.persist_collection(COL_GUILD)
+        if reply is not None:
+            await msg.channel.send(reply)
 
+
+    # Resolve, check and start a prefixed message's command, returns what to reply if it was turned away
+    def _dispatch(self, msg, prefix):
         # message content
         content = msg.content.strip()
         
         # command
-        if len(content) > 1 and content[0] == guilds[guild]['prefix'] and content[1] != ' ':
+        if len(content) > 1 and content[1] != ' ':
             cmd_contents = content[1:].split()
             command = cmd_contents[0]
             args = cmd_contents[1:]
 
-            # check for aliases
-            for cmd, data in self.commands.items():
-                if 'aliases' in data and command in data['aliases']:
-                    command = cmd
-                    break
+            # resolve name or alias
+            handler = self.dispatch.get(command)
+            if handler is None or handler.disabled:
+                return None
 
-            # check for declared command
-            if command in self.commands:
+            command = handler.name
 
-                # command disabled
-                if 'disabled' in self.commands[command] and self.commands[command]['disabled'] == 1:
-                    return
+            # shutting down, let what is running finish
+            if self.tasks.draining:
+                return None
 
-                # admin
-                if 'permission' in self.commands[command] \
-                    and len(self.commands[command]['permission']) > 0 \
-                    and self.commands[command]['permission'].lower() != 'any':
-                    perm_tag = self.commands[command]['permission'].lower()
+            # as many running as the command allows, nothing to spend a rate token on
+            if handler.concurrency > 0 and self.tasks.running(command) >= handler.concurrency:
+                if self.limiter.should_notify(SCOPE_COMMAND, msg.author.id, msg.guild.id):
+                    return f'`{command}` is busy right now, try again in a moment'
+                return None
 
-                    # need to set up admin permissions....right now just me
-                    if perm_tag == 'admin' and str(msg.author.id) not in GOD_IDS:
-                        await msg.channel.send(f'You are not authorized to run command `{command}`')
-                        return
+            # over a limit: drop it before it costs a task, and say so at most once per window
+            limited = self.limiter.check(command, handler.limits, msg.author.id, msg.guild.id)
+            if limited is not None:
+                scope, wait = limited
+                self.logger.debug(f'rate limited {msg.author.display_name} on \'{command}\' ({scope})')
+                if self.limiter.should_notify(scope, msg.author.id, msg.guild.id):
+                    who = 'You are' if scope == SCOPE_USER else 'This server is' if scope == SCOPE_GUILD else 'Everyone is'
+                    return f'{who} using `{command}` too often, try again in {wait:.1f}s'
+                return None
 
-                self.logger.debug(f'user {msg.author.display_name} called on: \'{command}\'')
+            # admin
+            if handler.permission != 'any':
 
-                method_name = command
+                # need to set up admin permissions....right now just me
+                if handler.permission == 'admin' and str(msg.author.id) not in GOD_IDS:
+                    return f'You are not authorized to run command `{command}`'
 
-                if 'function' in self.commands[command]:
-                    method_name = self.commands[command]['function']
+            self.logger.debug(f'user {msg.author.display_name} called on: \'{command}\'')
 
-                if hasattr(self, method_name):
-                    method = getattr(self, method_name)
-                    if asyncio.iscoroutinefunction(method):
+            # check arg minimum requirement
+            if len(args) < handler.argmin:
+                if handler.usage is not None:
+                    return f'Usage: `{prefix}{command} {handler.usage}`'
+                return None
+
+            #self.logger.debug(f'executing function for: \'{command}\'')
+            self.tasks.spawn(command, handler.method(msg, *args), guild_id=msg.guild.id, limit=handler.concurrency)
+
+        return None
+
+
+    # Build the prefix table from the guild collection
+    def _load_prefixes(self):
+        prefixes = {}
+        for guild, settings in self.store.get_collection(COL_GUILD).items():
+            if isinstance(settings, dict) and 'prefix' in settings:
+                prefixes[int(guild)] = settings['prefix']
+        return prefixes
+
+
+    # Pick up one guild's prefix after another process changed it
+    def _reload_prefix(self, guild):
+        settings = self.store.get_collection_item(COL_GUILD, guild)
+        if isinstance(settings, dict) and 'prefix' in settings:
+            self.prefixes[int(guild)] = settings['prefix']
+        else:
+            self.prefixes.pop(int(guild), None)
+
+
+    # First message from a guild: cache its prefix, store defaults through the write-behind path
+    def _register_guild(self, guild_id):
+        guild = str(guild_id)
+        settings = self.store.get_collection_item(COL_GUILD, guild)
+
+        # make sure to load guild data, first time write
+        if settings is None:
+            self.store.set_collection_item(COL_GUILD, guild, {'prefix': self.config.bot_prefix})
+
+        # set up guild specific data
+        elif 'prefix' not in settings:
+            self.store.set_collection_path(COL_GUILD, [guild, 'prefix'], self.config.bot_prefix)
+
+        prefix = settings['prefix'] if settings is not None and 'prefix' in settings else self.config.bot_prefix
+        self.prefixes[guild_id] = prefix
+        return prefix
+
+
+    def _prefix(self, guild_id):
+        prefix = self.prefixes.get(guild_id)
+        return prefix if prefix is not None else self._register_guild(guild_id)
+
+
+    # Queue a sound for the guild's player and tell the caller where it landed
+    async def _queue_sound(self, msg, track_name, timeout=None, events=None):
+        position = self.playback.submit(msg.guild.id, PlayRequest(msg, track_name, timeout=timeout, events=events))
+
+        if position is None:
+            await msg.channel.send(f'The queue is full, try `{track_name}` again in a bit')
+        elif position > 0:
+            await msg.channel.send(f'Queued `{track_name}` (position {position})')
 
-                        # check arg minimum requirement
-                        if 'argmin' in self.commands[command] and len(args) < self.commands[command]['argmin']:
-                            if 'usage' in self.commands[command]:
-                                await msg.channel.send(f'Usage: `{guilds[guild]["prefix"]}{command} {self.commands[command]["usage"]}`')
-                            return
-                        
-                        #self.logger.debug(f'executing function for: \'{command}\'')
-                        self.loop.create_task(method(msg, *args))
-                    else:
-                        self.logger.error(f'function not coroutine for command: {command}')
-                else:
-                    self.logger.error(f'could not find function to call for command: {command}')
-
-
-    # Needed for other soundbit commands
-    def _ensure_collection(self, guild_id):
-        # set up the soundbit store - use defaults
-        if not self.store.has_collection(f'{COL_SOUNDS}-{guild_id}'):
-            self.store.use_collection(f'{COL_SOUNDS}-{guild_id}')
-            self.logger.info(f'first time guild [{guild_id}], creating collection')
-
-        # get global tracks
-        track_globals = None
-        if self.store.has_collection(f'{COL_SOUNDS}-{COL_GLOBAL}'):
-            track_globals = self.store.get_collection(f'{COL_SOUNDS}-{COL_GLOBAL}')
-            
-        track_store = self.store.get_collection(f'{COL_SOUNDS}-{guild_id}')
 
-        # if no bits, load the globals
-        if 'bits' not in track_store:
-            if track_globals is not None and 'bits' in track_globals and isinstance(track_globals['bits'], dict):
-                track_store['bits'] = track_globals['bits']
-                self.logger.info(f'no bits in new guild [{guild_id}], adding {len(track_globals["bits"].keys())} global sounds')
-            else:
-                track_store['bits'] = {}
+    # Scheduler callbacks
+    async def _play_request(self, request: PlayRequest):
+        await self._play_sound(request.msg, request.track_name, timeout=request.timeout, events=request.events, request=request)
 
-            self.store.set_collection(f'{COL_SOUNDS}-{guild_id}', track_store)
-            self.store.persist_collection(f'{COL_SOUNDS}-{guild_id}')
 
-        return track_store
+    def _stop_playing(self, guild_id):
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None and guild.voice_client is not None and guild.voice_client.is_playing():
+            self._skipped.add(guild_id)
+            guild.voice_client.stop()
 
 
     # Play a sound in a channel (target based on calling user), set track name and timeout
-    async def _play_sound(self, msg, track_name, timeout=None, events=None):
+    async def _play_sound(self, msg, track_name, timeout=None, events=None, request=None):
         target = msg.author
 
-        if timeout is None:
+        # known lengths size the timeout, a caller's timeout still caps it
+        record = self._record(msg.guild.id, track_name)
+        meta = record.get('meta') if record is not None else None
+        duration = meta.get('duration') if meta is not None else None
+        if duration is not None:
+            timeout = min(timeout, duration + self.config.audio_timeout_slack) if timeout is not None else duration + self.config.audio_timeout_slack
+        elif timeout is None:
             timeout = self.config.audio_timeout
 
         # Author isnt in a channel, see if anyone else is
         if target.voice is None or target.voice.channel is None:
-            audio_channels = msg.guild.voice_channels
-            #print(f'audio channels: {audio_channels}')
-            for ac in audio_channels:
-                #print(f'voice states in channel {ac.name}: {ac.voice_states}')
-                for user_id, vs in ac.voice_states.items():
-                    if vs.channel is not None and not vs.self_deaf:
-                        channel = vs.channel
-                        break
-                if channel is not None:
-                    break
+            channel = self.voice_states.find_channel(msg.guild)
 
         # Pick author's channel alternatively (priority)
         else:
@@ -197,101 +530,133 @@ class Soundbyte(commands.Cog):
         if channel is None:
             return
 
-        # Make sure bot isnt already connected 
-        for vc in self.bot.voice_clients:
-            if vc.channel.id == channel.id:
-                self.logger.debug(f'bot already connected to the channel! {channel.id}')
+        # Find the audio bit file, the guild's blob first, then files by name in the server and common dirs
+        digest = record.get('blob') if record is not None else None
+        if digest is not None:
+            filename = self.blobs.path(digest)
+            cache_key = OpusCache.blob_key(digest)
+        else:
+            location = self.sounds.resolve(msg.guild.id, track_name)
+            if location is None:
+                self.logger.error(f'sound error: \'{track_name}\' not found for guild {msg.guild.id}')
                 return
 
-        # Read audio bit file
-        audio_dir = os.path.join(self.config.audio_root, self.config.audio_server_storage)
-        filename = os.path.join(audio_dir, f'{msg.guild.id}', track_name + '.' + AUDIO_FILE_EXT)
-        if not os.path.isfile(filename):
+            filename, is_global = location
+            cache_key = OpusCache.track_key(None if is_global else msg.guild.id, track_name)
 
-            # check in the comman dir
-            audio_dir = os.path.join(self.config.audio_root, self.config.audio_common_storage)
-            filename = os.path.join(audio_dir, track_name + '.' + AUDIO_FILE_EXT)
-            
-            if not os.path.isfile(filename):
-                self.logger.error(f'sound error: \'{filename} not found\'')
-                return
+        # Get the guild's pooled voice client in this channel
+        vc = await self.voice.acquire(channel)
+        if vc is None:
+            return
 
-        # Connect to voice channel
+        # from here on the client, any ffmpeg slot and the source are given back however playing ends
+        source = None
+        started = False
+        slot = False
+        event_tasks = []
+        pending = {}
+        finished = False
         try:
-            vc = await channel.connect(timeout=2.0) # get voice client
-        except discord.ClientException:
-            self.logger.debug(f'bot already connected to the channel! {channel.id}')
-            return
-        except asyncio.TimeoutError:
-            self.logger.error(f'connecting to channel {channel.id} timed out!')
-            return
+            # skipped while connecting or waiting for a slot
+            if request is not None and request.cancelled:
+                return
 
-        # Play the audio file
-        vc.play(discord.FFmpegPCMAudio(source=filename))
+            # Pre-encoded opus streams straight from disk, anything else needs an ffmpeg slot
+            source = self.opus_cache.source(cache_key)
+            if source is None:
+                slot = await self._audio_slot(msg, track_name, events is not None, duration)
+                if not slot or (request is not None and request.cancelled):
+                    return
 
-        # Wait on it...asyncio timeout didnt seem to work
-        count_up = 0
-        event_tasks = []
-        while timeout > 0 and vc.is_playing() and vc.is_connected():
-            if events is not None:
-
-                # check queue for events that should be started
-                do_events = []
-                rm_events = []
-                for idx, event in enumerate(events):
-                    if count_up >= event['at']:
-
-                        # TODO check that handler is an awaitable coroutine
-                        if 'handler' not in event:
-                            self.logger.debug(f'Skipping non-couroutine event: {event["handler"] if "handler" in event else "unknown"}')
-                            rm_events.append(idx)
-                            continue
-
-                        self.logger.debug(f'Starting event in queue @{event["at"]} seconds, handler: {event["name"]}')
-                        do_events.append(idx)
-                
-                # start the tasks and remove from queue
-                for do_event in do_events:
-                    event_tasks.append(asyncio.create_task(events[do_event]['handler'](*events[do_event]['args'])))
-                    del events[do_event]
-
-                # remove bad events so they're not retried
-                for rm_event in rm_events:
-                    del events[rm_event]
-
-            # check every second
-            await asyncio.sleep(1.0)
-            timeout -= 1
-            count_up += 1
-
-        if vc.is_playing():
-            vc.stop()
-
-        if vc.is_connected():
-            await vc.disconnect()
-
-        # Queue remaining events post sound loop
-        if events is not None and len(events) > 0:
-            self.logger.debug(f'Queuing remaining {len(events)} events after sound loop')
-            for event in events:
+                FFMPEG_SPAWNS.labels('play').inc()
+                source = discord.FFmpegPCMAudio(source=filename)
+
+            # command to first frame, as the user hears it
+            source = FirstFrameSource(source, lambda: FIRST_FRAME_SECONDS.observe((discord.utils.utcnow() - msg.created_at).total_seconds()))
+
+            # The player calls back from its own thread when the source ends or is stopped
+            done = self.loop.create_future()
+
+            def _after(error):
+                if error is not None:
+                    self.logger.error(f'player error for \'{track_name}\': {str(error)}')
+                self.loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+            self._skipped.discard(msg.guild.id)
+            vc.play(source, after=_after)
+            started = True
+
+            # Start each timed event at its offset, counted back from the clip end when its length is known
+            end = min(duration, timeout) if duration is not None else None
+
+            def _start_event(idx, event):
+                pending.pop(idx, None)
+                self.logger.debug(f'Starting event @{event["at"]} seconds, handler: {event["name"]}')
+                event_tasks.append(self.tasks.spawn(event.get('name', 'event'), event['handler'](*event['args']), guild_id=msg.guild.id))
+
+            for idx, event in enumerate(events if events is not None else []):
                 # TODO check that handler is an awaitable coroutine
                 if 'handler' not in event:
-                    self.logger.debug(f'Skipping non-couroutine event: {event["handler"] if "handler" in event else "unknown"}')
-                    rm_events.append(idx)
+                    self.logger.debug(f'Skipping non-couroutine event: {event.get("name", "unknown")}')
                     continue
-                
-                self.logger.debug(f'Starting event handler post-loop: {event["name"]}')
-                event_tasks.append(asyncio.create_task(event['handler'](*event['args'])))
+                if end is not None and 'before_end' in event:
+                    event['at'] = max(0, end - event['before_end'])
+                pending[idx] = (self.loop.call_later(event['at'], _start_event, idx, event), event)
+
+            try:
+                await asyncio.wait_for(asyncio.shield(done), timeout)
+                finished = msg.guild.id not in self._skipped
+            except asyncio.TimeoutError:
+                self.logger.debug(f'sound \'{track_name}\' timed out after {timeout} seconds')
+        finally:
+            for timer, _ in pending.values():
+                timer.cancel()
+
+            if vc.is_playing():
+                vc.stop()
+
+            # the player cleans up sources it was given
+            if source is not None and not started:
+                source.cleanup()
+
+            if slot:
+                self.audio_pool.release()
+
+            # Stay connected until the pool's idle timeout
+            self.voice.release(msg.guild)
+
+        # Sound ended on its own before some events were due, run them now
+        if finished and len(pending) > 0:
+            self.logger.debug(f'Starting remaining {len(pending)} events after sound ended')
+            for idx, (_, event) in list(pending.items()):
+                _start_event(idx, event)
 
         # Gather tasks
         if len(event_tasks) > 0:
             self.logger.debug(f'Awaiting queue of {len(event_tasks)} events')
-            await asyncio.gather(*event_tasks)
-            self.logger.debug(f'Tasks gathered')
+            # failures are logged by the supervisor
+            await asyncio.gather(*event_tasks, return_exceptions=True)
+            self.logger.debug('Tasks gathered')
 
         self.logger.info(f'Finished playing sound \'{track_name}\'')
 
     
+    # Wait for an ffmpeg slot, outros and shorter clips ahead of longer ones; tells the caller if it has to wait or is turned away
+    async def _audio_slot(self, msg, track_name, outro, duration):
+        priority = (PRIORITY_OUTRO if outro else PRIORITY_PLAY, duration if duration is not None else self.config.audio_timeout)
+
+        if not self.audio_pool.available():
+            self.logger.debug(f'audio pool busy, \'{track_name}\' waits behind {self.audio_pool.depth()}')
+            if self.audio_pool.depth() < self.audio_pool.max_waiting:
+                await msg.channel.send(f'Lots of sounds playing right now, `{track_name}` will start in a moment')
+
+        if not await self.audio_pool.acquire(priority):
+            self.logger.warning(f'audio pool full, turned away \'{track_name}\' in guild {msg.guild.id}')
+            await msg.channel.send(f'Too many sounds playing right now, try `{track_name}` again in a bit')
+            return False
+        return True
+
+
     # Disconnect user
     async def _dc_user(self, user):
         await user.move_to(None)
@@ -313,37 +678,36 @@ class Soundbyte(commands.Cog):
             return
 
         track_name = '_'.join(map(lambda arg: arg.strip(), args))
-        track_store = self._ensure_collection(msg.guild.id)
 
-        # ensure store is ok
-        tracks = track_store['bits']
+        # check for this audio file, a unique prefix of one is good enough
+        if not self.catalog.has(msg.guild.id, track_name):
+            matches = self.catalog.search.prefix(msg.guild.id, track_name, 2)
+            if len(matches) != 1:
+                await msg.channel.send(self._unknown_sound(msg.guild.id, track_name))
+                return
+            track_name = matches[0]
+        
+        await self._queue_sound(msg, track_name)
 
-        # convert to new store
-        if isinstance(tracks, list):
-            new_store = {}
 
-            for track in tracks:
-                new_store[track] = {
-                    'name': track,
-                    'outro': {},
-                    'intro': {}
-                }
-                
-            track_store['bits'] = new_store
+    # Reply for a name that does not resolve, with suggestions if any are close
+    def _unknown_sound(self, guild_id, track_name):
+        suggestions = self.catalog.search.suggest(guild_id, track_name, self.config.search_suggestions)
+        if len(suggestions) == 0:
+            return f'I don\'t know the sound `{track_name}`'
+        return f'I don\'t know the sound `{track_name}`, did you mean {", ".join(f"`{name}`" for name in suggestions)}?'
 
-            self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', new_store)
-            self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
 
-        if not isinstance(tracks, dict):
-            self.logger.error(f'error reading track store for server [{msg.guild.name}]')
-            return
-        
-        # check for this audio file
-        if not track_name in tracks:
-            await msg.channel.send(f'I don\'t know the sound `{track_name}`')
+    # Find sounds by name
+    async def search(self, msg: discord.Message, *args):
+        query = '_'.join(map(lambda arg: arg.strip(), args))
+        results = self.catalog.search.suggest(msg.guild.id, query, self.config.search_results)
+
+        if len(results) == 0:
+            await msg.channel.send(f'No sounds look like `{query}`')
             return
-        
-        await self._play_sound(msg, track_name)
+
+        await msg.channel.send(embed=discord.Embed(title=f'Sounds like {query}', description='\n'.join(results)))
 
 
     # Remove a sound
@@ -353,49 +717,49 @@ class Soundbyte(commands.Cog):
             return
 
         track_name = '_'.join(map(lambda arg: arg.strip(), args))
-        track_store = self._ensure_collection(msg.guild.id)
 
-        # Ensure store is ok
-        tracks = track_store['bits']
+        # Check for this audio file
+        if not self.catalog.has(msg.guild.id, track_name):
+            await msg.channel.send(self._unknown_sound(msg.guild.id, track_name))
+            return
 
-        if not isinstance(tracks, dict):
-            self.logger.error(f'error reading track store for server [{msg.guild.name}]')
+        # Global sounds are only hidden for this server
+        if self.catalog.is_global(msg.guild.id, track_name):
+            self.catalog.remove(msg.guild.id, track_name)
+            await msg.channel.send(f'Sound is global, removed `{track_name}` from this server\'s list')
             return
-        
-        # Check for this audio file
-        if not track_name in tracks:
-            await msg.channel.send(f'I don\'t know the sound `{track_name}`')
+
+        # Drop this name's reference, the file goes with the last one
+        record = self.catalog.own(msg.guild.id, track_name)
+        digest = record.get('blob') if isinstance(record, dict) else None
+        if digest is not None:
+            self.catalog.remove(msg.guild.id, track_name)
+            if self.blobs.unref(digest):
+                self.opus_cache.remove(OpusCache.blob_key(digest))
+
+            await msg.channel.send(f'Removed `{track_name}`')
             return
         
-        # Read audio bit file
-        audio_dir = os.path.join(self.config.audio_root, self.config.audio_server_storage)
-        filename = os.path.join(audio_dir, f'{msg.guild.id}', track_name + '.' + AUDIO_FILE_EXT)
+        # Find audio bit file
+        location = self.sounds.resolve(msg.guild.id, track_name)
 
         # File does not exist in the server list
-        if not os.path.isfile(filename):
-            global_audio_dir = os.path.join(self.config.audio_root, self.config.audio_common_storage)
-            global_filename = os.path.join(global_audio_dir, track_name + '.' + AUDIO_FILE_EXT)
-            
-            if not os.path.isfile(global_filename):
-                self.logger.warning(f'sound error: file \'{filename}\' not found.  removed track from list: {track_name}')
-                del track_store['bits'][track_name]
-                self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', track_store)
-                self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
-
-                await msg.channel.send(f'Sound file not found, removed the listing for `{track_name}`')
-            else:
-                await msg.channel.send(f'Sound is global, cannot delete `{track_name}`')
+        if location is None or location[1]:
+            self.logger.warning(f'sound error: file for \'{track_name}\' not found.  removed track from list: {track_name}')
+            self.catalog.remove(msg.guild.id, track_name)
 
+            await msg.channel.send(f'Sound file not found, removed the listing for `{track_name}`')
             return
                 
         # File exists
+        filename = location[0]
         try:
 
             # Try to delete the file, and only remove the listing if successful
             os.remove(filename)
-            del track_store['bits'][track_name]
-            self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', track_store)
-            self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
+            self.sounds.remove(msg.guild.id, track_name)
+            self.opus_cache.remove(OpusCache.track_key(msg.guild.id, track_name))
+            self.catalog.remove(msg.guild.id, track_name)
 
             await msg.channel.send(f'Removed `{track_name}`')
         except Exception as e:
@@ -416,137 +780,149 @@ class Soundbyte(commands.Cog):
             await msg.channel.send('Please include a name for this soundbit!')
             return
 
-        guild = str(msg.guild.id)
-        guilds = self.store.get_collection(COL_GUILD)
-
-        # Look for sound attachment
-        added = False
-        async for message in msg.channel.history(limit=2):
-            att = message.attachments
-            for media in att:
-                type = media.content_type.split('/')
-                if type[0] == 'audio':
-                    if type[1] in AUDIO_FILE_TYPES:
-                        self.logger.debug(f'found sound in {msg.channel.name} [format={type[1]}], saving')
-
-                        # check on server dir
-                        audio_dir = resolve_path(os.path.join(self.config.audio_root, self.config.audio_server_storage, f'{msg.guild.id}'), force_exists=False)
-                        if not os.path.isdir(audio_dir):
+        prefix = self._prefix(msg.guild.id)
+
+        # only add names that do not already resolve, or are being added right now
+        if self.catalog.has(msg.guild.id, track_name) or (msg.guild.id, track_name) in self._ingesting:
+            await msg.channel.send(f'Cannot overwrite existing sound `{track_name}`')
+            return
+
+        # hold the name from here, so a second add of it cannot pass the check while this one downloads
+        self._ingesting.add((msg.guild.id, track_name))
+        try:
+            # Look for sound attachment
+            added = False
+            async for message in msg.channel.history(limit=2):
+                att = message.attachments
+                for media in att:
+                    type = media.content_type.split('/')
+                    if type[0] == 'audio':
+                        if type[1] in AUDIO_FILE_TYPES:
+                            self.logger.debug(f'found sound in {msg.channel.name} [format={type[1]}], ingesting')
+
+                            # nothing is visible to plays or the store until the file is validated and in place
                             try:
-                                os.mkdir(audio_dir)
-                            except Exception as e:
-                                self.logger.error(f'could not create new server dir: {str(e)}')
+                                digest, meta = await self.ingest.ingest(media)
+                            except IngestError as e:
+                                self.logger.info(f'rejected upload for \'{track_name}\' in guild ({msg.guild.name}): {e.message}')
+                                await msg.channel.send(e.message)
+                                return
+                            except OSError as e:
+                                self.logger.error(f'could not store upload for \'{track_name}\': {str(e)}')
+                                await msg.channel.send('Could not save that sound, try again later')
                                 return
-                        
-                        # save sound
-                        filename = os.path.join(audio_dir, track_name    + '.' + AUDIO_FILE_EXT)
-                        await media.save(filename)
-
-                        track_store = self._ensure_collection(msg.guild.id)
-
-                        # ensure store is ok
-                        tracks = track_store['bits']
-                        
-                        # convert to new store
-                        if isinstance(tracks, list):
-                            new_store = {}
-
-                            for track in tracks:
-                                new_store[track] = {
-                                    'name': track,
-                                    'outro': {},
-                                    'intro': {}
-                                }
-
-                            track_store['bits'] = new_store
-
-                            self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', new_store)
-                            self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
-
-                        if not isinstance(tracks, dict):
-                            self.logger.error(f'error reading track store for server ({msg.guild.name})')
-                            return
 
-                        # add file to store if it does not already exist
-                        if track_name not in tracks:
+                            # identical files share one blob and one cache entry
+                            self.blobs.ref(digest, meta)
+                            key = OpusCache.blob_key(digest)
+                            if not self.opus_cache.has(key):
+                                gain = normalize_gain(meta, self.config.audio_normalize_lufs, self.config.audio_peak_ceiling)
+                                self.tasks.spawn('encode', self.opus_cache.encode(self.blobs.path(digest), key, gain), guild_id=msg.guild.id)
+
+                            # add file to the guild's own sounds
                             self.logger.info(f'appending track to guild ({msg.guild.name}): {track_name}')
-                            
-                            track_store['bits'][track_name] = {
+                            self.catalog.add(msg.guild.id, track_name, {
                                 'name': track_name,
-                                'outro': {},
-                                'intro': {}
-                            }
-
-                            self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', track_store)
-                            self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
+                                'intro': {},
+                                'meta': meta,
+                                'blob': digest
+                            })
 
                             await msg.channel.send(f'Added new sound `{track_name}`')
                             added = True
 
+                            break
+
                         else:
-                            await msg.channel.send(f'Cannot overwrite existing sound `{track_name}`')
+                            await msg.channel.send('Unsupported file type \'' + type[1] + '\'')
                             return
-
-                        break
-
                     else:
                         await msg.channel.send('Unsupported file type \'' + type[1] + '\'')
                         return
-                else:
-                    await msg.channel.send('Unsupported file type \'' + type[1] + '\'')
-                    return
 
-        if not added:
-            await msg.channel.send(f'Send an audio file in chat, then type `{guilds[guild]["prefix"]}add [name]`')
+                if added:
+                    break
+
+            if not added:
+                await msg.channel.send(f'Send an audio file in chat, then type `{prefix}add [name]`')
+        finally:
+            self._ingesting.discard((msg.guild.id, track_name))
 
 
     async def list(self, msg: discord.Message, *args):
-        track_store = self._ensure_collection(msg.guild.id)
-        tracks = track_store['bits']
+        pages = self._list_pages(msg.guild.id)
 
-        author_id = msg.author.id
-        author_display_name = msg.author.display_name
+        if len(pages) == 0:
+            prefix = self._prefix(msg.guild.id)
+            
+            await msg.channel.send(f'No soundbits stored!  Upload an mp3, then type `{prefix}add [name]` to add one.')
+            return
 
-        # convert to new store
-        if isinstance(tracks, list):
-            new_store = {}
+        page = 0
+        if len(args) > 0:
+            if not args[0].isdigit():
+                await msg.channel.send(f'Usage: `{self._prefix(msg.guild.id)}list [page]`')
+                return
+            page = min(max(int(args[0]), 1), len(pages)) - 1
 
-            for track in tracks:
-                new_store[track] = {
-                    'name': track,
-                    'outro': {},
-                    'intro': {}
-                }
+        if len(pages) == 1:
+            await msg.channel.send(embed=pages[0])
+            return
 
-            track_store['bits'] = new_store
-            
-            self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', track_store)
-            self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
+        view = SoundbyteListView(self, msg.guild.id, page, self.config.list_view_seconds)
+        view.message = await msg.channel.send(embed=pages[page], view=view)
 
-        if not isinstance(tracks, dict):
-            self.logger.error(f'error reading track store for server [{msg.guild.name}]')
-            return
 
-        if len(tracks) == 0:
-            guild = str(msg.guild.id)
-            guilds = self.store.get_collection(COL_GUILD)
-            
-            await msg.channel.send(f'No soundbits stored!  Upload an mp3, then type `{guilds[guild]["prefix"]}add [name]` to add one.')
-        else:
-            track_list = []
+    # Rendered list embeds for a guild, rebuilt only when its catalog changed
+    def _list_pages(self, guild_id):
+        version = self.catalog.version(guild_id)
+        cached = self._list_cache.get(guild_id)
+        if cached is not None and cached[0] == version:
+            self._list_cache.move_to_end(guild_id)
+            return cached[1]
 
-            for track_name, track_data in tracks.items():
-                track_str = f'{track_name}'
+        outros = self.catalog.outros_by_track(guild_id)
+        overlay = self.catalog.overlay(guild_id)
+        global_bits = self.catalog.global_bits()
+        descriptions = []
+        lines = []
+        length = 0
 
-                # outro: { 'nates_id': { display_name: 'drunk_irishman', id: 'nates_id' } }
-                if 'outro' in track_data and isinstance(track_data['outro'], dict) and len(track_data['outro'].keys()) > 0:
-                    track_str += f' (outro for: `{", ".join([user["display_name"] for user in track_data["outro"].values()])}`)'
+        for track_name in self.catalog.names(guild_id):
+            track_str = f'{track_name}'
 
-                track_list.append(track_str)
+            record = overlay['bits'].get(track_name, global_bits.get(track_name))
+            meta = record.get('meta') if isinstance(record, dict) else None
+            if meta is not None and meta.get('duration') is not None:
+                track_str += f' `{meta["duration"]:.1f}s`'
 
-            track_str = "\n".join(track_list)
+            if track_name in outros:
+                track_str += f' (outro for: `{", ".join(outros[track_name])}`)'
 
-            await msg.channel.send(embed=discord.Embed(title='Tracks', description=track_str))
+            # start a new page on the line count, or before the description gets too long for discord
+            if len(lines) > 0 and (len(lines) >= self.config.list_page_size or length + len(track_str) + 1 > EMBED_DESC_MAX):
+                descriptions.append('\n'.join(lines))
+                lines = []
+                length = 0
+
+            lines.append(track_str[:EMBED_DESC_MAX])
+            length += len(track_str) + 1
+
+        if len(lines) > 0:
+            descriptions.append('\n'.join(lines))
+
+        pages = []
+        for idx, description in enumerate(descriptions):
+            embed = discord.Embed(title='Tracks', description=description)
+            if len(descriptions) > 1:
+                embed.set_footer(text=f'Page {idx + 1}/{len(descriptions)}')
+            pages.append(embed)
+
+        self._list_cache[guild_id] = (version, pages)
+        self._list_cache.move_to_end(guild_id)
+        while len(self._list_cache) > self.config.list_cache_guilds:
+            self._list_cache.popitem(last=False)
+        return pages
 
 
     async def setoutro(self, msg: discord.Message, *args):
@@ -555,29 +931,11 @@ class Soundbyte(commands.Cog):
         author_id = str(msg.author.id)
         author_display_name = msg.author.display_name
 
-        track_store = self._ensure_collection(msg.guild.id)
-        tracks = track_store['bits']
-
-        if not isinstance(tracks, dict):
-            self.logger.error(f'error reading track store for server [{msg.guild.name}]')
-            return
-
-        if outro_name not in tracks:
-            await msg.channel.send(f'I don\'t know the sound `{outro_name}`')
+        if not self.catalog.has(msg.guild.id, outro_name):
+            await msg.channel.send(self._unknown_sound(msg.guild.id, outro_name))
             return
 
-        for bit_name, bit_data in tracks.items():
-            if str(author_id) in bit_data['outro']:
-                del track_store['bits'][bit_name]['outro'][str(author_id)]
-
-        if str(author_id) not in track_store['bits'][outro_name]['outro']:
-            track_store['bits'][outro_name]['outro'][str(author_id)] = {
-                'display_name': author_display_name,
-                'id': author_id
-            }
-
-        self.store.set_collection(f'{COL_SOUNDS}-{msg.guild.id}', track_store)
-        self.store.persist_collection(f'{COL_SOUNDS}-{msg.guild.id}')
+        self.catalog.set_outro(msg.guild.id, author_id, outro_name, author_display_name)
 
         self.logger.info(f'set user \'{author_display_name}\' [{author_id}] to \'{outro_name}\'')
         await msg.channel.send(f'Set user `{author_display_name}` outro to `{outro_name}`')
@@ -585,39 +943,78 @@ class Soundbyte(commands.Cog):
 
     # Play user outro
     async def outro(self, msg: discord.Message, *args):
-        guild = str(msg.guild.id)
-        guilds = self.store.get_collection(COL_GUILD)
+        prefix = self._prefix(msg.guild.id)
         
         author_id = str(msg.author.id)
         author_display_name = msg.author.display_name
 
-        track_store = self._ensure_collection(msg.guild.id)
-        tracks = track_store['bits']
-
-        for bit_name in tracks.keys():
-            if str(author_id) in tracks[bit_name]['outro']:
-                
-                # play outro music, disconnect user as an event during the timer
-                await self._play_sound(msg, bit_name, timeout=self.config.outro_timeout, events=[
-                    {
-                        'name': 'disconnect user',
-                        'at': self.config.outro_user_dc_seconds,
-                        'handler': self._dc_user,
-                        'args': [msg.author]
-                    },
-                    {
-                        'name': 'bot message',
-                        'at': self.config.outro_msg_seconds,
-                        'handler': self._msg_user,
-                        'args': [msg.channel, msg.author.display_name, bit_name]
-                    }
-                ])
+        bit_name = self.catalog.outro(msg.guild.id, author_id)
+        if bit_name is not None:
+
+            # play outro music, disconnect user as an event during the timer
+            await self._queue_sound(msg, bit_name, timeout=self.config.outro_timeout, events=[
+                {
+                    'name': 'disconnect user',
+                    'at': self.config.outro_user_dc_seconds,
+                    'before_end': self.config.outro_user_dc_before_end,
+                    'handler': self._dc_user,
+                    'args': [msg.author]
+                },
+                {
+                    'name': 'bot message',
+                    'at': self.config.outro_msg_seconds,
+                    'before_end': self.config.outro_msg_before_end,
+                    'handler': self._msg_user,
+                    'args': [msg.channel, msg.author.display_name, bit_name]
+                }
+            ])
 
-                return
+            return
 
-        await msg.channel.send(f'No outro set for you, {author_display_name}. Use `{guilds[guild]["prefix"]}setoutro [sound name]` to set your outro sound.')
+        await msg.channel.send(f'No outro set for you, {author_display_name}. Use `{prefix}setoutro [sound name]` to set your outro sound.')
     
 
+    # Skip the sound that is playing
+    async def skip(self, msg: discord.Message, *args):
+        current = self.playback.current(msg.guild.id)
+        if current is None or not self.playback.skip(msg.guild.id):
+            await msg.channel.send('Nothing is playing')
+            return
+
+        await msg.channel.send(f'Skipped `{current.track_name}`')
+
+
+    # Drop every queued sound
+    async def clear(self, msg: discord.Message, *args):
+        count = self.playback.clear(msg.guild.id)
+        await msg.channel.send(f'Cleared {count} queued sound{"" if count == 1 else "s"}')
+
+
+    # Audio worker and task load for this process
+    async def status(self, msg: discord.Message, *args):
+        stats = self.audio_pool.stats()
+        embed = discord.Embed(title='Status')
+        embed.add_field(name='Audio workers', inline=False, value='\n'.join([
+            f'running: {stats["running"]}/{stats["limit"]}',
+            f'waiting: {stats["waiting"]}',
+            f'granted: {stats["granted"]}, turned away: {stats["rejected"]}',
+            f'wait: {stats["wait_avg"]:.2f}s avg, {stats["wait_max"]:.2f}s max'
+        ]))
+
+        counts = self.tasks.counts()
+        embed.add_field(name='Tasks', inline=False, value='\n'.join([
+            f'running: {self.tasks.running()}, this server: {self.tasks.running(guild_id=msg.guild.id)}',
+            *[f'{name}: {count}' for name, count in sorted(counts.items())]
+        ]))
+
+        current = self.playback.current(msg.guild.id)
+        embed.add_field(name='Playback', inline=False, value='\n'.join([
+            f'playing: {current.track_name if current is not None else "nothing"}',
+            f'queued: {self.playback.depth(msg.guild.id)}/{self.playback.max_depth}'
+        ]))
+        await msg.channel.send(embed=embed)
+
+
     # Set server prefix
     async def setprefix(self, msg: discord.Message, *args):
 
@@ -627,20 +1024,12 @@ class Soundbyte(commands.Cog):
 
         prefix = args[0][0]
 
-        guild = str(msg.guild.id)
-        guilds = self.store.get_collection(COL_GUILD)
-
-        guilds[guild]['prefix'] = prefix
-
-        self.store.set_collection(COL_GUILD, guilds)
-        self.store.persist_collection(COL_GUILD)
+        self.store.set_collection_path(COL_GUILD, [str(msg.guild.id), 'prefix'], prefix)
+        self.prefixes[msg.guild.id] = prefix
 
 
     async def help(self, msg: discord.Message, *args):
-        guild = str(msg.guild.id)
-        guilds = self.store.get_collection(COL_GUILD)
-        
-        await self.helper.send_bot_help(msg.channel, guilds[guild]['prefix'])
+        await self.helper.send_bot_help(msg.channel, self._prefix(msg.guild.id))
 
         
 
@@ -652,9 +1041,22 @@ class SoundbyteHelp(commands.HelpCommand):
 
         self.config = config
         self.commands = commands
+        self._embeds = {} # prefix -> rendered help embed
+
+
+    # Commands changed, every cached embed is stale
+    def set_commands(self, commands):
+        self.commands = commands
+        self._embeds = {}
         
 
     async def send_bot_help(self, channel, prefix):
+        if prefix not in self._embeds:
+            self._embeds[prefix] = self._render(prefix)
+        await channel.send(embed=self._embeds[prefix])
+
+
+    def _render(self, prefix):
         embed = discord.Embed(title=f'{self.config.bot_title} help:')
         for cmd_name, cmd in self.commands.items():
 
@@ -673,7 +1075,7 @@ class SoundbyteHelp(commands.HelpCommand):
             cmdstr = f'{cmd["desc"]}\n`{prefix}{cmd_name} {cmd["usage"]}`'
             embed.add_field(name=f'{cmd_name}:', value=cmdstr, inline=False)
             
-        await channel.send(embed=embed)
+        return embed
 
 
     async def send_cog_help(self, cog):
@@ -686,3 +1088,52 @@ class SoundbyteHelp(commands.HelpCommand):
 
     async def send_command_help(self, command):
         return await super().send_command_help(command)
+
+
+
+class SoundbyteListView(discord.ui.View):
+    '''Previous/next buttons for a paged track list'''
+
+    def __init__(self, cog, guild_id, page, timeout):
+        super().__init__(timeout=timeout)
+
+        self.cog = cog
+        self.guild_id = guild_id
+        self.page = page
+        self.message = None
+        self._update_buttons(len(cog._list_pages(guild_id)))
+
+
+    def _update_buttons(self, count):
+        self.previous.disabled = self.page <= 0
+        self.next.disabled = self.page >= count - 1
+
+
+    # Pages come from the cog's cache, so a click after an add or remove shows the current list
+    async def _show(self, interaction: discord.Interaction, page):
+        pages = self.cog._list_pages(self.guild_id)
+        if len(pages) == 0:
+            await interaction.response.edit_message(content='No soundbits stored!', embed=None, view=None)
+            return
+
+        self.page = min(max(page, 0), len(pages) - 1)
+        self._update_buttons(len(pages))
+        await interaction.response.edit_message(embed=pages[self.page], view=self)
+
+
+    @discord.ui.button(label='◀', style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+
+    @discord.ui.button(label='▶', style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
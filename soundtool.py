@@ -0,0 +1,251 @@
+
+# soundtool.py - offline bulk import and export of sound libraries
+#
+#   python soundtool.py import <dir or .zip> (--guild <id> | --global) [--workers N] [--overwrite]
+#   python soundtool.py export (--guild <id> | --global) [--output <file.zip>]
+#
+# Works on the files and store configured in config.ini; stop the bot first, it keeps the store in memory
+
+import os, sys, json, asyncio, logging, argparse, tempfile, zipfile, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import BotConfig
+from constants import CONFIG_FILE, COL_SOUNDS, COL_GLOBAL, AUDIO_FILE_EXT
+from exceptions import ConfigLoadError, IngestError
+from store import SimpleStorageException, create_storage
+from library import SoundIndex
+from catalog import SoundCatalog
+from ingest import process, find_tool
+from blobs import BlobStore
+from audio import OpusCache, normalize_gain
+
+
+# archive entry holding the exported records
+LIBRARY_FILE = 'library.json'
+
+
+def _track_name(filename):
+    return '_'.join(os.path.splitext(os.path.basename(filename))[0].split())
+
+
+# Sound files in a directory, or extracted from a zip into workdir; files mapping to a name already taken are skipped
+def _sources(path, workdir, logger):
+    suffix = '.' + AUDIO_FILE_EXT
+    sources = {}
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(suffix):
+                    continue
+                if _track_name(info.filename) in sources:
+                    logger.warning(f'skipping {info.filename}, another file is already imported as \'{_track_name(info.filename)}\'')
+                    continue
+                # only the base name is used, entries cannot write outside workdir
+                target = os.path.join(workdir, f'{len(sources)}{suffix}')
+                with archive.open(info) as src, open(target, 'wb') as dst:
+                    while True:
+                        chunk = src.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                sources[_track_name(info.filename)] = target
+
+    elif os.path.isdir(path):
+        for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+            if entry.is_file() and entry.name.lower().endswith(suffix):
+                if _track_name(entry.name) in sources:
+                    logger.warning(f'skipping {entry.name}, another file is already imported as \'{_track_name(entry.name)}\'')
+                    continue
+                sources[_track_name(entry.name)] = entry.path
+
+    else:
+        raise IngestError(f'{path} is not a directory or zip file')
+
+    return sources
+
+
+def _audio_dir(config, logger, guild_id):
+    index = SoundIndex(config, logger)
+    return os.path.join(index.server_dir, str(guild_id)) if guild_id is not None else index.global_dir
+
+
+def import_library(config, store, logger, path, guild_id, workers, overwrite):
+    catalog = SoundCatalog(store, logger)
+    blobs = BlobStore(config, store, logger)
+    # guild sounds go to the blob store, global sounds stay files by name
+    audio_dir = _audio_dir(config, logger, guild_id) if guild_id is None else blobs.blob_dir
+    os.makedirs(audio_dir, exist_ok=True)
+
+    ffmpeg = find_tool(config.ffmpeg_exe, 'ffmpeg')
+    ffprobe = find_tool(config.ffprobe_exe, 'ffprobe')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        sources = _sources(path, workdir, logger)
+
+        existing = catalog.global_bits() if guild_id is None else catalog.overlay(guild_id)['bits']
+        if not overwrite:
+            for track_name in sorted(set(sources) & set(existing)):
+                logger.warning(f'skipping \'{track_name}\', already in the library (use --overwrite to replace)')
+                del sources[track_name]
+
+        logger.info(f'importing {len(sources)} sounds into {audio_dir} with {workers} workers')
+
+        # validate, transcode and measure in parallel, each into a temp file next to its target
+        records = {}
+        encodes = []  # (file, opus cache key, meta, whether an older encode must be replaced)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {}
+            for track_name, source in sources.items():
+                temp = os.path.join(audio_dir, f'.import-{len(futures)}.tmp')
+                futures[pool.submit(process, ffprobe, ffmpeg, source, temp, config.ingest_max_seconds, config.ingest_bitrate, config.ingest_timeout)] = (track_name, temp)
+
+            for future in as_completed(futures):
+                track_name, temp = futures[future]
+                try:
+                    meta = future.result()
+                except IngestError as e:
+                    logger.error(f'rejected \'{track_name}\': {e.message}')
+                    if os.path.isfile(temp):
+                        os.remove(temp)
+                    continue
+
+                records[track_name] = {'name': track_name, 'intro': {}, 'meta': meta}
+                if guild_id is None:
+                    filename = os.path.join(audio_dir, track_name + '.' + AUDIO_FILE_EXT)
+                    os.replace(temp, filename)
+                    # an overwritten global sound keeps its cache key, the old encode has to go
+                    encodes.append((filename, OpusCache.track_key(None, track_name), meta, track_name in existing))
+                else:
+                    digest = blobs.add(temp)
+                    records[track_name]['blob'] = digest
+                    encodes.append((blobs.path(digest), OpusCache.blob_key(digest), meta, False))
+
+    # overwritten names give up their old blobs once the new records are in
+    replaced = [existing[track_name].get('blob') for track_name in records if isinstance(existing.get(track_name), dict)]
+
+    # one write each for the whole batch
+    if len(records) > 0:
+        if guild_id is not None:
+            blobs.ref_many([(record['blob'], record['meta']) for record in records.values()])
+        catalog.add_many(guild_id, records)
+
+    cache = OpusCache(config, logger)
+    for digest in replaced:
+        if digest is not None and blobs.unref(digest):
+            cache.remove(OpusCache.blob_key(digest))
+
+    if config.opus_cache:
+        asyncio.run(_encode(cache, config, encodes, workers))
+
+    logger.info(f'imported {len(records)} of {len(sources)} sounds')
+    return len(records)
+
+
+# Pre-encode the imported sounds, a few ffmpeg processes at a time
+async def _encode(cache, config, encodes, workers):
+    slots = asyncio.Semaphore(workers)
+
+    async def encode(filename, key, meta, replace):
+        if replace:
+            cache.remove(key)
+        elif cache.has(key):
+            return
+        async with slots:
+            await cache.encode(filename, key, normalize_gain(meta, config.audio_normalize_lufs, config.audio_peak_ceiling))
+
+    # identical files share a key, encode each once
+    unique = {key: (filename, key, meta, replace) for filename, key, meta, replace in encodes}
+    await asyncio.gather(*[encode(*item) for item in unique.values()])
+
+
+def export_library(config, store, logger, guild_id, output):
+    catalog = SoundCatalog(store, logger)
+    blobs = BlobStore(config, store, logger)
+    audio_dir = _audio_dir(config, logger, guild_id)
+
+    if guild_id is None:
+        name = f'{COL_SOUNDS}-{COL_GLOBAL}'
+        library = {'bits': catalog.global_bits()}
+    else:
+        name = f'{COL_SOUNDS}-{guild_id}'
+        if not store.has_collection(name):
+            raise IngestError(f'no library stored for guild {guild_id}')
+        library = catalog.overlay(guild_id)
+
+    output = output if output is not None else f'{name}.zip'
+    exported = 0
+
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for track_name, record in library['bits'].items():
+            digest = record.get('blob') if isinstance(record, dict) else None
+            filename = blobs.path(digest) if digest is not None else os.path.join(audio_dir, track_name + '.' + AUDIO_FILE_EXT)
+            if not os.path.isfile(filename):
+                logger.warning(f'no file for \'{track_name}\', exporting its record only')
+                continue
+            # mp3 is already compressed
+            archive.write(filename, track_name + '.' + AUDIO_FILE_EXT, compress_type=zipfile.ZIP_STORED)
+            exported += 1
+
+        archive.writestr(LIBRARY_FILE, json.dumps(library, indent=4))
+
+    logger.info(f'exported {exported} sounds and {len(library["bits"])} records to {output}')
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import and export of soundbyte sound libraries')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    importer = subparsers.add_parser('import', help='import a directory or zip of sounds')
+    importer.add_argument('path')
+    importer.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    importer.add_argument('--overwrite', action='store_true', help='replace sounds that already exist')
+
+    exporter = subparsers.add_parser('export', help='export a library and its records as a zip')
+    exporter.add_argument('--output')
+
+    for sub in (importer, exporter):
+        target = sub.add_mutually_exclusive_group(required=True)
+        target.add_argument('--guild', type=int)
+        target.add_argument('--global', dest='is_global', action='store_true')
+
+    args = parser.parse_args()
+
+    logger = logging.getLogger('soundtool')
+    logger.setLevel(logging.INFO)
+    handle = logging.StreamHandler()
+    handle.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] |   %(message)s'))
+    logger.addHandler(handle)
+
+    store = None
+    try:
+        config = BotConfig(CONFIG_FILE)
+
+        store = create_storage(config, logger=logger)
+        store.load()
+        store.use_collection(f'{COL_SOUNDS}-{COL_GLOBAL}')
+
+        guild_id = None if args.is_global else args.guild
+        if args.command == 'import':
+            import_library(config, store, logger, args.path, guild_id, max(1, args.workers), args.overwrite)
+        else:
+            export_library(config, store, logger, guild_id, args.output)
+
+    except ConfigLoadError as e:
+        print(f'Error: {str(e)}')
+        return 1
+
+    except (SimpleStorageException, IngestError) as e:
+        logger.error(e.message)
+        return 1
+
+    finally:
+        if store is not None:
+            store.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
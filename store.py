@@ -1,7 +1,16 @@
 
-import json, os, shutil, logging
+import json, os, time, uuid, shutil, logging, tempfile, threading, sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# advisory locks, not available on windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from constants import resolve_path
+from metrics import STORE_WRITE_SECONDS, STORE_BYTES_WRITTEN
 
 class SimpleStorageException(Exception):
     def __init__(self, msg, *args) -> None:
@@ -16,17 +25,51 @@ class SimpleStorage:
 
     PERSIST_MANIFEST = 'manifest.json'
     PERSIST_FILE_EXT = '.dat'
+    LOCK_FILE = '.lock'
+
+    # retries when a collection is mutated while being serialized off-loop
+    SERIALIZE_RETRIES = 3
 
-    def __init__(self, store_dir) -> None:
+    def __init__(self, store_dir, write_behind=False, flush_interval=2.0, lazy=False, cache_size=256, logger=None) -> None:
         self.store_dir = store_dir
         self._ensure_dir()
 
-        self.storage = {}
+        # resident collections, least recently used first
+        self.storage = OrderedDict()
         self.meta = {
             'count': 0,
             'list': []
         }
 
+        # collections listed in the manifest, resident or not
+        self._known = set()
+
+        # lazy: collections are read on first use and cold ones evicted past cache_size
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self._pinned = set()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0
+        }
+
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        # write-behind: persist calls only mark collections dirty, a flusher thread writes them
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self._dirty = set()
+        self._manifest_dirty = False
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flusher = None
+
+        # held while loaded, file stores have a single writer
+        self._dir_lock = None
+        self.shared = False
+
     def _ensure_dir(self):
         if not os.path.isdir(self.store_dir):
             try:
@@ -41,59 +84,220 @@ class SimpleStorage:
 
     # AFTER load - add collection to storage, store in file, update meta
     def use_collection(self, name):
-        if len(self.storage) > 0 and name in self.storage:
+        if name in self.storage or name in self._known:
             return
         else:
             self.storage[name] = {}
+            self._known.add(name)
             self.meta['count'] = self.meta['count'] + 1
             self.meta['list'].append(name)
             self.persist_collection(name)
-            self.write_manifest()
+            self.persist_manifest()
+            self._evict(keep=name)
+
+    # Keep a collection resident regardless of cache pressure
+    def pin_collection(self, name):
+        self._pinned.add(name)
+
+    # Resident collection, faulted in from disk in lazy mode
+    def _get(self, name):
+        collection = self.storage.get(name)
+        if collection is not None:
+            if self.lazy:
+                self.storage.move_to_end(name)
+                self.stats['hits'] += 1
+            return collection
+
+        if not self.lazy or name not in self._known:
+            return None
+
+        self.stats['misses'] += 1
+        collection = self._read_collection(name)
+        if collection is None:
+            collection = {}
+
+        self.storage[name] = collection
+        self._evict(keep=name)
+        return collection
+
+    # Drop cold collections past cache_size, writing dirty ones out first
+    def _evict(self, keep=None):
+        if not self.lazy:
+            return
+
+        while len(self.storage) > self.cache_size:
+            candidates = [name for name in self.storage if name != keep and name not in self._pinned]
+            if len(candidates) == 0:
+                return
+
+            victim = next((name for name in candidates if not self._is_dirty(name)), None)
+            if victim is None:
+                victim = candidates[0]
+                self._flush_collection(victim)
+
+            del self.storage[victim]
+            self.stats['evictions'] += 1
 
+    def _is_dirty(self, name):
+        return name in self._dirty
+
+    # Write one collection now, outside the flusher
+    def _flush_collection(self, name):
+        with self._lock:
+            self._dirty.discard(name)
+        try:
+            self._write_collection(name)
+        except SimpleStorageException:
+            with self._lock:
+                self._dirty.add(name)
+            raise
+
+    # Lazy cache counters
+    def cache_stats(self):
+        return dict(self.stats, resident=len(self.storage), known=len(self._known))
 
     # Access a collection for reading and writing
     def get_collection(self, name):
-        if name in self.storage:
-            return self.storage[name]
+        collection = self._get(name)
+        if collection is not None:
+            return collection
         else:
             raise SimpleStorageException('collection does not exist')
 
     # Does this collection exist
     def has_collection(self, name):
-        return name in self.storage
+        return self._get(name) is not None
 
     # Clear a collection
     def clear_collection(self, name):
-        if name in self.storage:
+        if self._get(name) is not None:
             self.storage[name] = {}
 
     # Set entire collection
     def set_collection(self, name, data):
-        if name in self.storage and self.storage[name] != None:
+        if self._get(name) is not None:
             self.storage[name] = data
 
-    # Set a collection item (can just use getCollection reference)
+    # Read a single top-level item
+    def get_collection_item(self, name, key, default=None):
+        collection = self._get(name)
+        if collection is None:
+            return default
+        return collection.get(key, default)
+
+    # Set a collection item and persist the change
     def set_collection_item(self, name, key, item):
-        if name in self.storage and self.storage[name] != None:
-            self.storage[name][key] = item
+        self.set_collection_path(name, [key], item)
 
-    # Remove a collection item
+    # Remove a collection item and persist the change
     def remove_collection_item(self, name, key):
-        if name in self.storage and self.storage[name] != None:
-            if key in self.storage[name]:
-                del self.storage[name][key]
+        self.remove_collection_path(name, [key])
+
+    # Set a nested item, e.g. ['bits', track, 'outro', user_id], and persist the change
+    def set_collection_path(self, name, path, item):
+        collection = self._get(name)
+        if collection is not None:
+            if SimpleStorage._apply_set(collection, path, item):
+                self.persist_collection(name)
+
+    # Remove a nested item and persist the change
+    def remove_collection_path(self, name, path):
+        collection = self._get(name)
+        if collection is not None:
+            if SimpleStorage._apply_remove(collection, path):
+                self.persist_collection(name)
+
+    # Read-modify-write a nested item: fn gets the current value (None if missing) and returns the new one, None removes it
+    def update_collection_path(self, name, path, fn):
+        collection = self._get(name)
+        if collection is None:
+            return None
+
+        value = fn(SimpleStorage._lookup(collection, path))
+        if value is None:
+            self.remove_collection_path(name, path)
+        else:
+            self.set_collection_path(name, path, value)
+        return value
+
+    # Collections other processes changed since the last call, name -> top-level keys changed
+    # (None in the set when the whole collection was replaced); only shared stores see any
+    def poll_changes(self):
+        return {}
+
+    @staticmethod
+    def _lookup(collection, path):
+        node = collection
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return node
+
+    # Walk a key path creating dicts as needed, then set the leaf
+    @staticmethod
+    def _apply_set(collection, path, item):
+        node = collection
+        for key in path[:-1]:
+            if key not in node:
+                node[key] = {}
+            node = node[key]
+            if not isinstance(node, dict):
+                return False
+        node[path[-1]] = item
+        return True
+
+    # Walk a key path and delete the leaf if present
+    @staticmethod
+    def _apply_remove(collection, path):
+        node = collection
+        for key in path[:-1]:
+            if not isinstance(node, dict) or key not in node:
+                return False
+            node = node[key]
+        if not isinstance(node, dict) or path[-1] not in node:
+            return False
+        del node[path[-1]]
+        return True
+
+    # Write the manifest file (or mark it dirty in write-behind mode)
+    def persist_manifest(self):
+        if self.write_behind:
+            with self._lock:
+                self._manifest_dirty = True
+        else:
+            self.write_manifest()
 
     # Write the manifest file
     def write_manifest(self):
         try:
-            manifest = open(os.path.join(self.store_dir, SimpleStorage.PERSIST_MANIFEST), 'w')
-            manifest.write(json.dumps(self.meta))
-            manifest.close()
+            self._atomic_write(os.path.join(self.store_dir, SimpleStorage.PERSIST_MANIFEST), self._serialize(self.meta))
         except Exception as e:
             raise SimpleStorageException(f'error writing manifest: {e}')
 
+    # Take the storage directory for this process, a second process would overwrite our files
+    def _lock_dir(self):
+        if fcntl is None or self._dir_lock is not None:
+            return
+
+        lock = open(os.path.join(self.store_dir, SimpleStorage.LOCK_FILE), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise SimpleStorageException(f'storage dir {self.store_dir} is in use by another process, use the sqlite engine to share storage')
+        self._dir_lock = lock
+
+    def _unlock_dir(self):
+        if self._dir_lock is not None:
+            fcntl.flock(self._dir_lock, fcntl.LOCK_UN)
+            self._dir_lock.close()
+            self._dir_lock = None
+
     # Load all state data
     def load(self):
+        self._lock_dir()
+
         n = 0 # loaded collections count
         newList = [] # loaded collections keys
         rewrite = False # should meta be rewritten
@@ -128,19 +332,20 @@ class SimpleStorage:
             rewrite = True
 
             for item in list:
-                try:
-                    file = open(os.path.join(self.store_dir, item + SimpleStorage.PERSIST_FILE_EXT), 'r')
-                    str = ''.join(file.readlines())
-                    if len(str) > 0:
-                        collection = json.loads(str)
-                        if collection != None:
-                            self.storage[item] = collection
-                            newList.append(item)
-                            n += 1
-                except:
-                    raise SimpleStorageException(f'error reading storage file for collection: {item}')
-                finally:
-                    file.close()
+
+                # lazy mode only trusts the manifest, collections are read on first use
+                if self.lazy:
+                    newList.append(item)
+                    n += 1
+                    continue
+
+                collection = self._read_collection(item)
+                if collection != None:
+                    self.storage[item] = collection
+                    newList.append(item)
+                    n += 1
+
+            self._known = set(newList)
 
         except Exception as e:
             raise SimpleStorageException(f'error reading storage objects: {e}')
@@ -153,17 +358,791 @@ class SimpleStorage:
                 self.meta['list'] = newList
                 self.write_manifest()
 
-    # Store collection data
+        if self.write_behind:
+            self._start_flusher()
+
+    # Read one collection file, None if it is empty
+    def _read_collection(self, name):
+        try:
+            with open(os.path.join(self.store_dir, name + SimpleStorage.PERSIST_FILE_EXT), 'r') as file:
+                str = file.read()
+            if len(str) > 0:
+                return json.loads(str)
+            return None
+        except:
+            raise SimpleStorageException(f'error reading storage file for collection: {name}')
+
+    # Store collection data (or mark it dirty in write-behind mode)
     def persist_collection(self, name):
         if self.storage != None and len(self.storage) > 0 and name in self.storage:
-            str = json.dumps(self.storage[name])
-            f = None
+            if self.write_behind:
+                with self._lock:
+                    self._dirty.add(name)
+            else:
+                self._write_collection(name)
+
+    # Serialize and write one collection to its file
+    def _write_collection(self, name, data=None):
+        if data is None:
+            data = self.storage.get(name)
+        if data is None:
+            return
+
+        try:
+            self._atomic_write(os.path.join(self.store_dir, name + SimpleStorage.PERSIST_FILE_EXT), self._serialize(data))
+            #print(f'storage: wrote collection [{name}] ({len(self.storage[name])} lines)')
+        except:
+            raise SimpleStorageException(f'error writing collection: {name}')
+
+    # Dump an object that may be mutated by the event loop during a background write
+    def _serialize(self, data):
+        for attempt in range(SimpleStorage.SERIALIZE_RETRIES):
             try:
-                f = open(os.path.join(self.store_dir, name + SimpleStorage.PERSIST_FILE_EXT), "w")
+                return json.dumps(data)
+            except RuntimeError:
+                if attempt == SimpleStorage.SERIALIZE_RETRIES - 1:
+                    raise
+
+    # Write to a temp file in the same dir and rename over the target
+    def _atomic_write(self, filename, str):
+        start = time.perf_counter()
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix='.tmp-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
                 f.write(str)
-                #print(f'storage: wrote collection [{name}] ({len(self.storage[name])} lines)')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_name, filename)
+            STORE_WRITE_SECONDS.observe(time.perf_counter() - start)
+            STORE_BYTES_WRITTEN.inc(len(str))
+        except:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+    # Write all dirty collections and the manifest now
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                # hold the data itself, a collection may be evicted while we write
+                pending = [(name, self.storage.get(name)) for name in self._dirty]
+                self._dirty = set()
+                manifest_dirty = self._manifest_dirty
+                self._manifest_dirty = False
+
+            failed = []
+            for name, data in pending:
+                try:
+                    self._write_collection(name, data)
+                except SimpleStorageException as e:
+                    self.logger.error(f'storage flush: {e.message}')
+                    failed.append(name)
+
+            if manifest_dirty:
+                try:
+                    self.write_manifest()
+                except SimpleStorageException as e:
+                    self.logger.error(f'storage flush: {e.message}')
+                    failed.append(None)
+
+            # keep failed writes queued for the next pass
+            if len(failed) > 0:
+                with self._lock:
+                    for name in failed:
+                        if name is None:
+                            self._manifest_dirty = True
+                        else:
+                            self._dirty.add(name)
+                raise SimpleStorageException(f'error flushing {len(failed)} storage objects')
+
+    # Background thread merging bursts of persist calls into one write per interval
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+
+        self._stop_event.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, name='storage-flusher', daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except SimpleStorageException:
+                pass # logged, retried next interval
+
+    # Stop the flusher and write anything pending, call on shutdown
+    def close(self):
+        if self._flusher is not None:
+            self._stop_event.set()
+            self._flusher.join()
+            self._flusher = None
+
+        try:
+            self.flush()
+        finally:
+            self._unlock_dir()
+
+
+class JournalStorage(SimpleStorage):
+    '''SimpleStorage that appends key-level changes to a log instead of rewriting collections'''
+
+    JOURNAL_FILE = 'journal.log'
+    JOURNAL_ROTATED = 'journal.log.1'
+
+    def __init__(self, store_dir, compact_bytes=1048576, **kwargs) -> None:
+        super().__init__(store_dir, **kwargs)
+
+        self.compact_bytes = compact_bytes
+
+        self._journal = None
+        self._journal_size = 0
+        self._compactor = None
+
+        # collections with journaled changes newer than their .dat snapshot
+        self._unsnapshotted = set()
+
+    def _journal_path(self, filename):
+        return os.path.join(self.store_dir, filename)
+
+    # Load snapshots, then replay the rotated and current journals on top
+    def load(self):
+        super().load()
+
+        replayed = 0
+        for filename in [JournalStorage.JOURNAL_ROTATED, JournalStorage.JOURNAL_FILE]:
+            replayed += self._replay(self._journal_path(filename))
+
+        # fold the replayed log into fresh snapshots so we start with an empty journal
+        if replayed > 0:
+            self.logger.info(f'storage: replayed {replayed} journal records')
+            self._write_snapshots([(name, self.storage.get(name)) for name in self._unsnapshotted])
+            self.write_manifest()
+            self._unsnapshotted = set()
+
+        for filename in [JournalStorage.JOURNAL_ROTATED, JournalStorage.JOURNAL_FILE]:
+            if os.path.isfile(self._journal_path(filename)):
+                os.remove(self._journal_path(filename))
+
+        self._open_journal()
+
+    # Apply every record of a journal file, stopping at a torn trailing write
+    def _replay(self, filename):
+        if not os.path.isfile(filename):
+            return 0
+
+        n = 0
+        with open(filename, 'r', encoding='utf-8') as file:
+            for line_no, line in enumerate(file):
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.warning(f'storage: stopping journal replay at {filename}:{line_no + 1}, unreadable record')
+                    break
+
+                self._apply_record(record)
+                n += 1
+
+        return n
+
+    def _apply_record(self, record):
+        name = record['c']
+
+        collection = self._get(name)
+        if collection is None:
+            collection = self.storage[name] = {}
+            self._known.add(name)
+            self.meta['count'] = self.meta['count'] + 1
+            self.meta['list'].append(name)
+
+        if record['op'] == 'put':
+            self.storage[name] = record['v']
+        elif record['op'] == 'set':
+            SimpleStorage._apply_set(collection, record['p'], record['v'])
+        elif record['op'] == 'del':
+            SimpleStorage._apply_remove(collection, record['p'])
+
+        self._unsnapshotted.add(name)
+
+    def _open_journal(self):
+        filename = self._journal_path(JournalStorage.JOURNAL_FILE)
+        self._journal = open(filename, 'a', encoding='utf-8')
+        self._journal_size = os.path.getsize(filename)
+
+    # Append one record, compacting in the background once the log is large
+    def _append(self, record):
+        line = json.dumps(record) + '\n'
+        try:
+            with self._lock:
+                start = time.perf_counter()
+                self._journal.write(line)
+                self._journal.flush()
+                STORE_WRITE_SECONDS.observe(time.perf_counter() - start)
+                STORE_BYTES_WRITTEN.inc(len(line))
+                self._journal_size += len(line)
+                self._unsnapshotted.add(record['c'])
+                compact = self._journal_size >= self.compact_bytes and self._compactor is None
+        except Exception as e:
+            raise SimpleStorageException(f'error appending to journal: {e}')
+
+        if compact:
+            self._compactor = threading.Thread(target=self._compact, name='storage-compactor', daemon=True)
+            self._compactor.start()
+
+    # New collections get an empty snapshot right away so load() always finds their file
+    def use_collection(self, name):
+        if name in self.storage or name in self._known:
+            return
+
+        super().use_collection(name)
+        self._write_collection(name)
+
+    def set_collection_path(self, name, path, item):
+        collection = self._get(name)
+        if collection is not None:
+            if SimpleStorage._apply_set(collection, path, item):
+                self._append({'op': 'set', 'c': name, 'p': path, 'v': item})
+
+    def remove_collection_path(self, name, path):
+        collection = self._get(name)
+        if collection is not None:
+            if SimpleStorage._apply_remove(collection, path):
+                self._append({'op': 'del', 'c': name, 'p': path})
+
+    # Callers that mutated a collection by reference log the whole collection
+    def persist_collection(self, name):
+        if self.storage != None and len(self.storage) > 0 and name in self.storage:
+            self._append({'op': 'put', 'c': name, 'v': self.storage[name]})
+
+    # Rotate the journal, snapshot the collections it covered, then drop the rotated log
+    def _compact(self):
+        try:
+            with self._lock:
+                # hold the data itself, a collection may be evicted while we write
+                pending = [(name, self.storage.get(name)) for name in self._unsnapshotted]
+                names = self._unsnapshotted
+                self._unsnapshotted = set()
+
+                self._journal.close()
+                current = self._journal_path(JournalStorage.JOURNAL_FILE)
+                rotated = self._journal_path(JournalStorage.JOURNAL_ROTATED)
+
+                # a previous compaction failed, fold the current log into the rotated one
+                if os.path.isfile(rotated):
+                    with open(current, 'r', encoding='utf-8') as src, open(rotated, 'a', encoding='utf-8') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(current)
+                else:
+                    os.replace(current, rotated)
+
+                self._open_journal()
+
+            # records appended after rotation are replayed on top of these snapshots, which is idempotent
+            try:
+                self._write_snapshots(pending)
+                self.write_manifest()
+                os.remove(rotated)
+                self.logger.debug(f'storage: compacted journal into {len(names)} collections')
+            except Exception as e:
+                with self._lock:
+                    self._unsnapshotted |= names
+                self.logger.error(f'storage: journal compaction failed: {e}')
+
+        finally:
+            self._compactor = None
+
+    def _write_snapshots(self, pending):
+        for name, data in pending:
+            self._write_collection(name, data)
+
+    def _is_dirty(self, name):
+        return name in self._unsnapshotted or super()._is_dirty(name)
+
+    # A snapshot makes the journaled changes for this collection redundant
+    def _flush_collection(self, name):
+        with self._lock:
+            self._unsnapshotted.discard(name)
+        try:
+            super()._flush_collection(name)
+        except SimpleStorageException:
+            with self._lock:
+                self._unsnapshotted.add(name)
+            raise
+
+    def flush(self):
+        super().flush()
+
+        with self._lock:
+            if self._journal is not None:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+        super().close()
+
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class SqliteStorage(SimpleStorage):
+    '''SimpleStorage backed by an SQLite database in WAL mode
+
+    Collections are stored one row per key, two levels deep: a row holds
+    collection[k1][k2] (e.g. one guild setting, or one track under 'bits'),
+    or collection[k1] itself when that is not a non-empty dict. Changing a
+    nested item only rewrites the row that contains it.
+
+    Shared: several processes use the same database. Every write is logged
+    to the changes table, and poll_changes() reloads what other processes
+    wrote.
+    '''
+
+    DB_FILE = 'soundbyte.db'
+    ROW_DEPTH = 2
+
+    # change log rows kept for processes that poll late
+    CHANGES_KEPT = 10000
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS collections (name TEXT PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS items (collection TEXT NOT NULL, key TEXT NOT NULL, parent TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (collection, key)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS items_parent ON items (collection, parent)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, top TEXT, origin TEXT NOT NULL)'
+    ]
+
+    def __init__(self, store_dir, db_file=None, shared=False, **kwargs) -> None:
+        super().__init__(store_dir, **kwargs)
+
+        self.db_file = os.path.join(self.store_dir, db_file if db_file is not None else SqliteStorage.DB_FILE)
+
+        # other processes only see what is in the database, so shared stores write through
+        self.shared = shared
+        self.origin = uuid.uuid4().hex
+        self._seq = 0  # last change log row seen
+        if self.shared and self.write_behind:
+            self.logger.warning('storage: write-behind is disabled for storage shared between processes')
+            self.write_behind = False
+
+        # row changes waiting for the flusher, keyed by (collection, k1, k2)
+        self._pending_rows = set()
+        self._db_lock = threading.RLock()
+
+        try:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('PRAGMA busy_timeout=5000')
+            for statement in SqliteStorage.SCHEMA:
+                self._db.execute(statement)
+        except sqlite3.Error as e:
+            raise SimpleStorageException(f'could not open storage database {self.db_file}: {e}')
+
+    @contextmanager
+    def _transaction(self):
+        with self._db_lock:
+            start = time.perf_counter()
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
             except:
-                raise SimpleStorageException(f'error writing collection: {name}')
-            finally:
-                if f is not None:
-                    f.close()
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            STORE_WRITE_SECONDS.observe(time.perf_counter() - start)
+
+    # Load collection names, importing manifest.json and .dat files on first run
+    def load(self):
+        try:
+            with self._db_lock:
+                imported = self._db.execute('SELECT value FROM meta WHERE key = ?', ('imported',)).fetchone()
+                names = [row[0] for row in self._db.execute('SELECT name FROM collections ORDER BY name')]
+
+            if imported is None and len(names) == 0:
+                manifest_file = os.path.join(self.store_dir, SimpleStorage.PERSIST_MANIFEST)
+                if os.path.isfile(manifest_file):
+                    names = self.import_files(self.store_dir)
+
+            self.meta = {
+                'count': len(names),
+                'list': names
+            }
+            self._known = set(names)
+
+            if not self.lazy:
+                for name in names:
+                    self.storage[name] = self._read_collection(name)
+
+            with self._db_lock:
+                self._seq = self._db.execute('SELECT coalesce(max(seq), 0) FROM changes').fetchone()[0]
+
+        except sqlite3.Error as e:
+            raise SimpleStorageException(f'error reading storage objects: {e}')
+
+        if self.write_behind:
+            self._start_flusher()
+
+    # One-shot import of a JSON file store (manifest.json plus <collection>.dat files)
+    def import_files(self, store_dir):
+        manifest_file = os.path.join(store_dir, SimpleStorage.PERSIST_MANIFEST)
+        try:
+            with open(manifest_file, 'r') as manifest:
+                meta = json.loads(manifest.read())
+        except Exception as e:
+            raise SimpleStorageException(f'error reading manifest for import: {e}')
+
+        imported = []
+        with self._transaction() as db:
+            for name in meta.get('list', []):
+                filename = os.path.join(store_dir, name + SimpleStorage.PERSIST_FILE_EXT)
+                if not os.path.isfile(filename):
+                    self.logger.warning(f'storage import: missing file for collection {name}, skipping')
+                    continue
+
+                collection = self._read_file(filename)
+                if collection is None:
+                    collection = {}
+
+                self._replace_rows(db, name, collection)
+                imported.append(name)
+
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('imported', manifest_file))
+
+        self.logger.info(f'storage: imported {len(imported)} collections from {manifest_file}')
+        return sorted(imported)
+
+    def _read_file(self, filename):
+        try:
+            with open(filename, 'r') as file:
+                str = file.read()
+            return json.loads(str) if len(str) > 0 else None
+        except:
+            raise SimpleStorageException(f'error reading storage file: {filename}')
+
+    # Rebuild a collection from its rows
+    def _read_collection(self, name):
+        try:
+            with self._db_lock:
+                rows = self._db.execute('SELECT key, value FROM items WHERE collection = ?', (name,)).fetchall()
+        except sqlite3.Error:
+            raise SimpleStorageException(f'error reading storage rows for collection: {name}')
+
+        collection = {}
+        for key, value in rows:
+            path = json.loads(key)
+            if len(path) == 1:
+                collection[path[0]] = json.loads(value)
+            else:
+                node = collection.setdefault(path[0], {})
+                node[path[1]] = json.loads(value)
+        return collection
+
+    # Indexed point lookup, served from the database when the collection is not resident
+    def get_collection_item(self, name, key, default=None):
+        if name in self.storage or name not in self._known:
+            return super().get_collection_item(name, key, default)
+
+        top = json.dumps([key])
+        try:
+            with self._db_lock:
+                rows = self._db.execute('SELECT key, value FROM items WHERE collection = ? AND (key = ? OR parent = ?)', (name, top, top)).fetchall()
+        except sqlite3.Error:
+            raise SimpleStorageException(f'error reading storage item: {name}/{key}')
+
+        if len(rows) == 0:
+            return default
+
+        item = {}
+        for row_key, value in rows:
+            path = json.loads(row_key)
+            if len(path) == 1:
+                return json.loads(value)
+            item[path[1]] = json.loads(value)
+        return item
+
+    @staticmethod
+    def _row(name, path, value):
+        parent = json.dumps(path[:1]) if len(path) > 1 else '[]'
+        value = json.dumps(value)
+        STORE_BYTES_WRITTEN.inc(len(value))
+        return (name, json.dumps(path), parent, value)
+
+    # Replace collection[k1] in memory with what the database holds
+    def _reload_top(self, db, name, collection, k1):
+        top = json.dumps([k1])
+        rows = db.execute('SELECT key, value FROM items WHERE collection = ? AND (key = ? OR parent = ?)', (name, top, top)).fetchall()
+
+        collection.pop(k1, None)
+        for key, value in rows:
+            path = json.loads(key)
+            if len(path) == 1:
+                collection[k1] = json.loads(value)
+            else:
+                collection.setdefault(k1, {})[path[1]] = json.loads(value)
+
+    # Replace collection[k1][k2] in memory with what the database holds, leaving the rest of collection[k1] alone
+    def _reload_row(self, db, name, collection, k1, k2):
+        top, key = json.dumps([k1]), json.dumps([k1, k2])
+        rows = dict(db.execute('SELECT key, value FROM items WHERE collection = ? AND key IN (?, ?)', (name, top, key)).fetchall())
+
+        if key in rows:
+            if not isinstance(collection.get(k1), dict):
+                collection[k1] = {}
+            collection[k1][k2] = json.loads(rows[key])
+        elif top in rows:
+            collection[k1] = json.loads(rows[top])
+        elif isinstance(collection.get(k1), dict):
+            collection[k1].pop(k2, None)
+
+    # Tell other processes what changed, top None for the whole collection
+    def _log_change(self, db, name, k1=None):
+        if self.shared:
+            db.execute('INSERT INTO changes (collection, top, origin) VALUES (?, ?, ?)', (name, json.dumps([k1]) if k1 is not None else None, self.origin))
+
+    # Delete every row under collection[k1] and write it back from memory
+    def _replace_top(self, db, name, collection, k1):
+        top = json.dumps([k1])
+        db.execute('DELETE FROM items WHERE collection = ? AND (key = ? OR parent = ?)', (name, top, top))
+
+        if k1 not in collection:
+            return
+
+        value = collection[k1]
+        if isinstance(value, dict) and len(value) > 0:
+            db.executemany('INSERT INTO items VALUES (?, ?, ?, ?)', [SqliteStorage._row(name, [k1, k2], v2) for k2, v2 in value.items()])
+        else:
+            db.execute('INSERT INTO items VALUES (?, ?, ?, ?)', SqliteStorage._row(name, [k1], value))
+
+    # Sync the single row holding collection[k1][k2]
+    def _replace_row(self, db, name, collection, k1, k2):
+        value = collection.get(k1)
+        if not isinstance(value, dict) or len(value) == 0:
+            self._replace_top(db, name, collection, k1)
+            return
+
+        db.execute('DELETE FROM items WHERE collection = ? AND key = ?', (name, json.dumps([k1])))
+        if k2 in value:
+            db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)', SqliteStorage._row(name, [k1, k2], value[k2]))
+        else:
+            db.execute('DELETE FROM items WHERE collection = ? AND key = ?', (name, json.dumps([k1, k2])))
+
+    def _replace_rows(self, db, name, collection):
+        db.execute('DELETE FROM items WHERE collection = ?', (name,))
+        db.execute('INSERT OR IGNORE INTO collections VALUES (?)', (name,))
+
+        rows = []
+        for k1, value in collection.items():
+            if isinstance(value, dict) and len(value) > 0:
+                rows.extend(SqliteStorage._row(name, [k1, k2], v2) for k2, v2 in value.items())
+            else:
+                rows.append(SqliteStorage._row(name, [k1], value))
+        db.executemany('INSERT INTO items VALUES (?, ?, ?, ?)', rows)
+
+    # Whole-collection write, used by persist_collection and eviction
+    def _write_collection(self, name, data=None):
+        if data is None:
+            data = self.storage.get(name)
+        if data is None:
+            return
+
+        try:
+            with self._transaction() as db:
+                self._replace_rows(db, name, data)
+                self._log_change(db, name)
+        except Exception:
+            raise SimpleStorageException(f'error writing collection: {name}')
+
+    # Collection names live in their own table
+    def write_manifest(self):
+        try:
+            with self._transaction() as db:
+                db.executemany('INSERT OR IGNORE INTO collections VALUES (?)', [(name,) for name in self.meta['list']])
+        except sqlite3.Error as e:
+            raise SimpleStorageException(f'error writing manifest: {e}')
+
+    def set_collection_path(self, name, path, item):
+        collection = self._get(name)
+        if collection is not None:
+            if SimpleStorage._apply_set(collection, path, item):
+                self._persist_row(name, path)
+
+    def remove_collection_path(self, name, path):
+        collection = self._get(name)
+        if collection is not None:
+            if SimpleStorage._apply_remove(collection, path):
+                self._persist_row(name, path)
+
+    # Queue or write the row containing a changed path
+    def _persist_row(self, name, path):
+        row = (name, path[0], path[1] if len(path) >= SqliteStorage.ROW_DEPTH else None)
+        if self.write_behind:
+            with self._lock:
+                self._pending_rows.add(row)
+        else:
+            self._write_rows([row])
+
+    def _write_rows(self, rows):
+        try:
+            with self._transaction() as db:
+                for name, k1, k2 in rows:
+                    collection = self.storage.get(name)
+                    if collection is None:
+                        continue
+                    if k2 is None:
+                        self._replace_top(db, name, collection, k1)
+                    else:
+                        self._replace_row(db, name, collection, k1, k2)
+                    self._log_change(db, name, k1)
+        except Exception as e:
+            raise SimpleStorageException(f'error writing {len(rows)} storage rows: {e}')
+
+    # Atomic across processes when shared: the row is re-read under the database write lock
+    def update_collection_path(self, name, path, fn):
+        if not self.shared:
+            return super().update_collection_path(name, path, fn)
+
+        collection = self._get(name)
+        if collection is None:
+            return None
+
+        try:
+            with self._lock, self._transaction() as db:
+                if len(path) >= SqliteStorage.ROW_DEPTH:
+                    self._reload_row(db, name, collection, path[0], path[1])
+                else:
+                    self._reload_top(db, name, collection, path[0])
+
+                value = fn(SimpleStorage._lookup(collection, path))
+                if value is None:
+                    SimpleStorage._apply_remove(collection, path)
+                else:
+                    SimpleStorage._apply_set(collection, path, value)
+
+                if len(path) >= SqliteStorage.ROW_DEPTH:
+                    self._replace_row(db, name, collection, path[0], path[1])
+                else:
+                    self._replace_top(db, name, collection, path[0])
+                self._log_change(db, name, path[0])
+        except sqlite3.Error as e:
+            raise SimpleStorageException(f'error updating {name}/{path}: {e}')
+        return value
+
+    # Reload what other processes wrote since the last poll, returns the changed top keys per collection
+    def poll_changes(self):
+        if not self.shared:
+            return {}
+
+        try:
+            with self._lock, self._db_lock:
+                first = self._db.execute('SELECT min(seq) FROM changes').fetchone()[0]
+                rows = self._db.execute('SELECT seq, collection, top, origin FROM changes WHERE seq > ? ORDER BY seq', (self._seq,)).fetchall()
+
+                # the log was trimmed past what we saw, reload everything resident
+                missed = first is not None and first > self._seq + 1
+                if missed:
+                    self.logger.warning('storage: fell behind the change log, reloading all collections')
+
+                tops = set()
+                created = set()
+                for seq, name, top, origin in rows:
+                    self._seq = seq
+                    if origin == self.origin:
+                        continue
+
+                    if name not in self._known:
+                        self._known.add(name)
+                        self.meta['list'].append(name)
+                        self.meta['count'] = len(self.meta['list'])
+                        created.add(name)
+                    tops.add((name, top))
+
+                # lazy stores fault new collections in on first use, the others hold every collection
+                if not self.lazy:
+                    for name in created:
+                        self.storage[name] = self._read_collection(name) or {}
+
+                full = set(self.storage.keys()) if missed else {name for name, top in tops if top is None and name not in created}
+                for name in full:
+                    if name in self.storage:
+                        self.storage[name] = self._read_collection(name)
+
+                for name, top in tops:
+                    if top is not None and name not in full and name not in created and name in self.storage:
+                        self._reload_top(self._db, name, self.storage[name], json.loads(top)[0])
+
+                if len(rows) > 0:
+                    self._db.execute('DELETE FROM changes WHERE seq <= ?', (self._seq - SqliteStorage.CHANGES_KEPT,))
+        except sqlite3.Error as e:
+            raise SimpleStorageException(f'error reading storage changes: {e}')
+
+        changed = {name: {None} for name in full | created}
+        for name, top in tops:
+            if name not in full and name not in created:
+                changed.setdefault(name, set()).add(None if top is None else json.loads(top)[0])
+        return changed
+
+    def _is_dirty(self, name):
+        return super()._is_dirty(name) or any(row[0] == name for row in self._pending_rows)
+
+    # Pending rows of an evicted collection are read from memory, so write them all now
+    def _flush_collection(self, name):
+        if super()._is_dirty(name):
+            super()._flush_collection(name)
+        self.flush()
+
+    # Full collection writes first, then every queued row change in one transaction
+    def flush(self):
+        super().flush()
+
+        with self._flush_lock:
+            with self._lock:
+                rows = self._pending_rows
+                self._pending_rows = set()
+
+            if len(rows) == 0:
+                return
+
+            try:
+                self._write_rows(rows)
+            except SimpleStorageException as e:
+                self.logger.error(f'storage flush: {e.message}')
+                with self._lock:
+                    self._pending_rows |= rows
+                raise
+
+    def close(self):
+        super().close()
+
+        with self._db_lock:
+            self._db.close()
+
+
+# Build the storage engine selected in config, shared when several processes use it
+def create_storage(config, logger=None, shared=False):
+    if shared and config.storage_engine != 'sqlite':
+        raise SimpleStorageException(f'storage engine \'{config.storage_engine}\' cannot be shared between processes, use sqlite')
+
+    kwargs = {
+        'write_behind': config.storage_write_behind,
+        'flush_interval': config.storage_flush_interval,
+        'lazy': config.storage_lazy,
+        'cache_size': config.storage_cache_collections,
+        'logger': logger
+    }
+
+    if config.storage_engine == 'journal':
+        return JournalStorage(config.storage_dir, compact_bytes=config.storage_journal_compact_bytes, **kwargs)
+    elif config.storage_engine == 'sqlite':
+        return SqliteStorage(config.storage_dir, db_file=config.storage_sqlite_file, shared=shared, **kwargs)
+    elif config.storage_engine == 'simple':
+        return SimpleStorage(config.storage_dir, **kwargs)
+    else:
+        raise SimpleStorageException(f'unknown storage engine: {config.storage_engine}')
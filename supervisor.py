@@ -0,0 +1,97 @@
+
+# supervisor.py - owned command and event tasks, with concurrency caps and drain on shutdown
+
+import time, asyncio, logging
+
+from metrics import TASK_SECONDS, TASK_FAILURES
+
+
+class TaskSupervisor:
+    '''Keeps every command and event task it starts, counted per command and per guild
+
+    Failures are logged with how long the task ran, and shutdown can wait for in-flight work
+    instead of dropping it half done.
+    '''
+
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+
+        self.draining = False
+
+        self._tasks = {}    # task -> (name, guild id, start time)
+        self._names = {}    # name -> tasks running
+        self._guilds = {}   # guild id -> tasks running
+
+    # Start coro as a task, None if name already has limit tasks running (0 = no cap)
+    def spawn(self, name, coro, guild_id=None, limit=0):
+        if limit > 0 and self._names.get(name, 0) >= limit:
+            coro.close()
+            return None
+
+        task = asyncio.get_event_loop().create_task(coro)
+        self._tasks[task] = (name, guild_id, time.monotonic())
+        self._names[name] = self._names.get(name, 0) + 1
+        if guild_id is not None:
+            self._guilds[guild_id] = self._guilds.get(guild_id, 0) + 1
+
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        name, guild_id, start = self._tasks.pop(task)
+        elapsed = time.monotonic() - start
+
+        TaskSupervisor._decrement(self._names, name)
+        if guild_id is not None:
+            TaskSupervisor._decrement(self._guilds, guild_id)
+
+        if task.cancelled():
+            self.logger.debug(f'task \'{name}\' cancelled after {elapsed:.3f}s')
+            return
+
+        TASK_SECONDS.labels(name).observe(elapsed)
+        error = task.exception()
+        if error is not None:
+            TASK_FAILURES.labels(name).inc()
+            self.logger.error(f'task \'{name}\' in guild {guild_id} failed after {elapsed:.3f}s: {type(error).__name__}: {str(error)}',
+                exc_info=(type(error), error, error.__traceback__))
+        else:
+            self.logger.debug(f'task \'{name}\' finished in {elapsed:.3f}s')
+
+    @staticmethod
+    def _decrement(counts, key):
+        counts[key] -= 1
+        if counts[key] <= 0:
+            del counts[key]
+
+    # Tasks in flight, for one command and/or guild, or all of them
+    def running(self, name=None, guild_id=None):
+        if name is None and guild_id is None:
+            return len(self._tasks)
+        if guild_id is None:
+            return self._names.get(name, 0)
+        if name is None:
+            return self._guilds.get(guild_id, 0)
+        return sum(1 for task_name, task_guild, _ in self._tasks.values() if task_name == name and task_guild == guild_id)
+
+    # name -> tasks running
+    def counts(self):
+        return dict(self._names)
+
+    # Stop taking new work and wait up to timeout for what is running, cancelling whatever is left
+    async def drain(self, timeout):
+        self.draining = True
+
+        tasks = list(self._tasks)
+        if len(tasks) == 0:
+            return 0
+
+        self.logger.info(f'draining {len(tasks)} tasks, up to {timeout}s')
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+
+        if len(pending) > 0:
+            self.logger.warning(f'cancelling {len(pending)} tasks still running after {timeout}s: {", ".join(sorted(set(self._tasks[task][0] for task in pending)))}')
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
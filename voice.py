@@ -0,0 +1,235 @@
+
+# voice.py - per-guild voice connection pool
+
+import time, asyncio, logging
+
+import discord
+
+from metrics import VOICE_CONNECT_SECONDS
+
+
+class VoicePool:
+    '''Keeps one voice client per guild connected between plays'''
+
+    def __init__(self, bot, config, logger: logging.Logger, voice_states=None) -> None:
+        self.bot = bot
+        self.logger = logger
+        self.voice_states = voice_states
+
+        self.connect_timeout = config.voice_connect_timeout
+        self.idle_seconds = config.voice_idle_seconds
+        self.reconnect_attempts = config.voice_reconnect_attempts
+        self.reconnect_backoff = config.voice_reconnect_backoff
+
+        self._locks = {}       # guild id -> lock serializing connect/move
+        self._idle = {}        # guild id -> idle disconnect timer
+        self._in_use = {}      # guild id -> plays holding the client
+        self._channels = {}    # guild id -> last channel we were asked for
+        self._closing = set()  # guild ids we are disconnecting on purpose
+        self._reconnects = {}  # guild id -> background reconnect task
+
+    def _lock(self, guild_id):
+        if guild_id not in self._locks:
+            self._locks[guild_id] = asyncio.Lock()
+        return self._locks[guild_id]
+
+    # Where our client sits, from the voice state index when we have one
+    def _client_channel(self, vc):
+        if self.voice_states is not None:
+            channel_id = self.voice_states.client_channel(vc.guild.id)
+            if channel_id is not None:
+                return channel_id
+        return vc.channel.id
+
+    def _cancel_idle(self, guild_id):
+        timer = self._idle.pop(guild_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    # Get a connected voice client in this channel, reusing or moving the guild's client
+    async def acquire(self, channel):
+        guild_id = channel.guild.id
+        self._cancel_idle(guild_id)
+        self._channels[guild_id] = channel
+
+        async with self._lock(guild_id):
+            vc = channel.guild.voice_client
+
+            if vc is not None and vc.is_connected():
+                # busy clients stay where they are, the caller decides what to do
+                if self._client_channel(vc) != channel.id and not vc.is_playing():
+                    self.logger.debug(f'moving voice client in guild {guild_id} to channel {channel.id}')
+                    await vc.move_to(channel)
+            else:
+                if vc is not None:
+                    await self._disconnect(vc, guild_id)
+                vc = await self._connect(channel)
+
+            if vc is not None:
+                self._in_use[guild_id] = self._in_use.get(guild_id, 0) + 1
+            return vc
+
+    # Connect with exponential backoff between attempts
+    async def _connect(self, channel):
+        delay = self.reconnect_backoff
+        start = time.perf_counter()
+        for attempt in range(1, self.reconnect_attempts + 1):
+            try:
+                vc = await channel.connect(timeout=self.connect_timeout, reconnect=True)
+                VOICE_CONNECT_SECONDS.observe(time.perf_counter() - start)
+                return vc
+            except discord.ClientException:
+                # raced with another connect, use whatever is there
+                return channel.guild.voice_client
+            except asyncio.TimeoutError:
+                self.logger.warning(f'connecting to channel {channel.id} timed out (attempt {attempt}/{self.reconnect_attempts})')
+
+            if attempt < self.reconnect_attempts:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        self.logger.error(f'could not connect to channel {channel.id}')
+        return None
+
+    async def _disconnect(self, vc, guild_id):
+        self._closing.add(guild_id)
+        try:
+            await vc.disconnect(force=True)
+        finally:
+            self._closing.discard(guild_id)
+
+    # Done playing, disconnect only after the idle period
+    def release(self, guild):
+        guild_id = guild.id
+        self._in_use[guild_id] = max(0, self._in_use.get(guild_id, 0) - 1)
+        if self._in_use[guild_id] > 0:
+            return
+
+        self._cancel_idle(guild_id)
+        loop = asyncio.get_event_loop()
+        self._idle[guild_id] = loop.call_later(self.idle_seconds, lambda: loop.create_task(self._disconnect_idle(guild)))
+
+    async def _disconnect_idle(self, guild):
+        self._idle.pop(guild.id, None)
+
+        async with self._lock(guild.id):
+            vc = guild.voice_client
+            if vc is None or self._in_use.get(guild.id, 0) > 0 or vc.is_playing():
+                return
+
+            self.logger.debug(f'voice client in guild {guild.id} idle for {self.idle_seconds}s, disconnecting')
+            self._channels.pop(guild.id, None)
+            await self._disconnect(vc, guild.id)
+
+    # The bot was dropped from voice without us asking, reconnect while the client is still wanted
+    def handle_disconnect(self, guild):
+        guild_id = guild.id
+        if guild_id in self._closing or guild_id in self._reconnects:
+            return
+
+        wanted = self._in_use.get(guild_id, 0) > 0 or guild_id in self._idle
+        channel = self._channels.get(guild_id)
+        if not wanted or channel is None:
+            return
+
+        self.logger.info(f'voice client in guild {guild_id} dropped, reconnecting in background')
+        self._reconnects[guild_id] = asyncio.get_event_loop().create_task(self._reconnect(channel))
+
+    async def _reconnect(self, channel):
+        try:
+            async with self._lock(channel.guild.id):
+                if channel.guild.voice_client is None or not channel.guild.voice_client.is_connected():
+                    await self._connect(channel)
+        finally:
+            self._reconnects.pop(channel.guild.id, None)
+
+    # Disconnect everything, for shutdown
+    async def close(self):
+        for timer in self._idle.values():
+            timer.cancel()
+        self._idle = {}
+
+        for task in self._reconnects.values():
+            task.cancel()
+
+        for vc in list(self.bot.voice_clients):
+            await self._disconnect(vc, vc.guild.id)
+
+
+class VoiceStateIndex:
+    '''Per guild: channels with listeners and where our own client sits, kept current from voice state updates'''
+
+    def __init__(self, bot) -> None:
+        self.bot = bot
+
+        self._listeners = {}  # guild id -> {channel id: set of eligible member ids}, only non-empty sets
+        self._members = {}    # guild id -> {member id: channel id} for eligible members
+        self._clients = {}    # guild id -> channel id our client is in
+
+    # Eligible listeners are in a channel, not self-deafened, and not us
+    def _eligible(self, member, state):
+        return state is not None and state.channel is not None and not state.self_deaf and member.id != self.bot.user.id
+
+    # Full rebuild for one guild, on ready/join
+    def rebuild(self, guild):
+        self._listeners[guild.id] = {}
+        self._members[guild.id] = {}
+        self._clients.pop(guild.id, None)
+
+        for channel in guild.voice_channels:
+            for member_id, state in channel.voice_states.items():
+                if member_id == self.bot.user.id:
+                    self._clients[guild.id] = channel.id
+                elif state.channel is not None and not state.self_deaf:
+                    self._add(guild.id, member_id, channel.id)
+
+    def forget(self, guild):
+        self._listeners.pop(guild.id, None)
+        self._members.pop(guild.id, None)
+        self._clients.pop(guild.id, None)
+
+    def _add(self, guild_id, member_id, channel_id):
+        self._members.setdefault(guild_id, {})[member_id] = channel_id
+        self._listeners.setdefault(guild_id, {}).setdefault(channel_id, set()).add(member_id)
+
+    def _remove(self, guild_id, member_id):
+        channel_id = self._members.get(guild_id, {}).pop(member_id, None)
+        if channel_id is None:
+            return
+
+        listeners = self._listeners[guild_id].get(channel_id)
+        if listeners is not None:
+            listeners.discard(member_id)
+            if len(listeners) == 0:
+                del self._listeners[guild_id][channel_id]
+
+    # Apply one on_voice_state_update
+    def update(self, member, before, after):
+        guild_id = member.guild.id
+
+        if member.id == self.bot.user.id:
+            if after is not None and after.channel is not None:
+                self._clients[guild_id] = after.channel.id
+            else:
+                self._clients.pop(guild_id, None)
+            return
+
+        self._remove(guild_id, member.id)
+        if self._eligible(member, after):
+            self._add(guild_id, member.id, after.channel.id)
+
+    # Some channel with a listener in it, or None
+    def find_channel(self, guild):
+        listeners = self._listeners.get(guild.id)
+        if not listeners:
+            return None
+
+        for channel_id in listeners:
+            channel = guild.get_channel(channel_id)
+            if channel is not None:
+                return channel
+        return None
+
+    # Channel id our voice client is connected to in this guild, or None
+    def client_channel(self, guild_id):
+        return self._clients.get(guild_id)